@@ -0,0 +1,320 @@
+import argparse
+import glob
+import inspect
+import json
+import math
+import numbers
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import cv2
+from image_transforms.pipeline import POINT_OPERATIONS, SPATIAL_OPERATIONS, Pipeline
+from image_transforms.storage import compact
+from image_transforms.tiled import DEFAULT_TILE, convert_image, create_image, image_pixels, tiled_apply, tiled_recipe
+
+
+def is_number(value):
+    """
+    :param value: Value read from a recipe
+    :return: number: Whether the value is a finite int or float. JSON booleans are not numbers here
+    """
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and math.isfinite(value)
+
+
+PARAMETER_CHECKS = {    # Parameter of the recipe steps -> (whether a value is valid, description of the valid values)
+    'gamma': (lambda value: is_number(value) and value > 0, "a positive number"),
+    'std': (lambda value: is_number(value) and value >= 0, "a non negative number"),
+    'c': (is_number, "a number"),
+    'threshold': (lambda value: is_number(value) and value >= 0, "a non negative number"),
+    'window': (lambda value: is_number(value) and value > 0, "a positive number"),
+    'clip_limit': (lambda value: value is None or (is_number(value) and value > 0), "a positive number or null"),
+}
+
+
+def load_recipe(path):
+    """
+    Reads an edit recipe, a JSON list of steps such as [{"op": "equalise"}, {"op": "gamma", "gamma": 1.5},
+    {"op": "sharpen", "std": 2, "c": 0.5}]. Every step is checked before any image is read: the operation must exist,
+    its parameters must match the ones the operation takes and their values must be valid, so that a bad recipe fails
+    once instead of on every image
+
+    :param path: Path of the recipe file
+    :return: recipe: List of steps
+    """
+    with open(path) as f:
+        recipe = json.load(f)
+    if not isinstance(recipe, list):
+        raise ValueError("A recipe must be a list of steps, got %s" % type(recipe).__name__)
+    for index, step in enumerate(recipe):
+        check_step(index, step)
+    return recipe
+
+
+def check_step(index, step):
+    """
+    :param index: Position of the step in the recipe, for the error messages
+    :param step: Step of a recipe, e.g. {"op": "gamma", "gamma": 1.5}. Raises ValueError if it is not valid
+    """
+    if not isinstance(step, dict) or 'op' not in step:
+        raise ValueError("Step %d must be an object with an 'op', got %r" % (index, step))
+    params = dict(step)
+    name = params.pop('op')
+    operation = POINT_OPERATIONS.get(name) or SPATIAL_OPERATIONS.get(name)
+    if operation is None:
+        raise ValueError("Step %d: unknown operation '%s'" % (index, name))
+    signature = inspect.signature(operation)
+    unknown = sorted(set(params) - set(list(signature.parameters)[1:]))    # The first argument is the histogram or
+    # the image
+    if unknown:
+        raise ValueError("Step %d (%s): unknown parameter '%s'" % (index, name, unknown[0]))
+    try:
+        signature.bind(None, **params)    # Missing parameters
+    except TypeError as error:
+        raise ValueError("Step %d (%s): %s" % (index, name, error))
+    for param, value in params.items():
+        check, valid = PARAMETER_CHECKS[param]
+        if not check(value):
+            raise ValueError("Step %d (%s): '%s' must be %s, got %r" % (index, name, param, valid, value))
+
+
+def read_file(path):
+    """
+    Reads the encoded bytes of an image. Runs on the prefetching threads
+
+    :param path: Path of the image
+    :return: data: Contents of the file
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_file(path, data):
+    """
+    Writes the encoded bytes of an image. Runs on the writer thread
+
+    :param path: Path of the output image
+    :param data: Encoded image
+    """
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def process_image(data, recipe, extension):
+    """
+    Decodes an image, applies the recipe and encodes the result. Runs on the worker processes
+
+    :param data: Encoded input image
+    :param recipe: List of steps
+    :param extension: Extension giving the output format, e.g. '.png'
+    :return: (encoded, pixels, timings): Encoded output image, number of pixels and the time spent in every stage
+    """
+    start = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    decoded = time.perf_counter()
+
+    result = Pipeline.from_recipe(img, recipe).materialise(cache=None)    # Every file is distinct, so the transform
+    # cache could never hit and would only hash the images and hold on to the results
+    transformed = time.perf_counter()
+
+    ok, encoded = cv2.imencode(extension, compact(result))
+    if not ok:
+        raise ValueError("Could not encode image as '%s'" % extension)
+    encoded_at = time.perf_counter()
+    timings = {'decode': decoded - start, 'transform': transformed - decoded, 'encode': encoded_at - transformed}
+    return encoded.tobytes(), img.shape[0] * img.shape[1], timings
+
+
+def process_large_image(path, recipe, destination, tile=DEFAULT_TILE):
+    """
+    Worker function for images too large to be decoded in RAM. The image is converted to a memory mapped file next
+    to the output, the recipe is applied tile by tile and the result is written from its memory map
+
+    :param path: Path of the input image
+    :param recipe: List of steps, only the operations of tiled.TILED_OPERATIONS
+    :param destination: Path of the output image
+    :param tile: Side of the tiles
+    :return: (encoded, pixels, timings): None as the output is already written, number of pixels and the time spent
+     in every stage
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix='ee610_tiles_', dir=os.path.dirname(destination) or '.') as work_dir:
+        # Next to the output rather than in the temporary directory, which may be in RAM
+        img = convert_image(path, os.path.join(work_dir, 'input.npy'))
+        decoded = time.perf_counter()
+        result = tiled_recipe(img, recipe, work_dir, tile)
+        if result.dtype != np.uint8:    # Compacted tile by tile, not as a whole in RAM
+            result = tiled_apply(result, create_image(os.path.join(work_dir, 'output.npy'), result.shape, np.uint8),
+                                 compact, 0, tile)
+        transformed = time.perf_counter()
+        if not cv2.imwrite(destination, result):    # The encoder reads the pixels through the memory map
+            raise OSError("Could not write '%s'" % destination)
+        pixels = img.shape[0] * img.shape[1]
+        del img, result    # The memory maps must be closed before the directory is removed
+    encoded_at = time.perf_counter()
+    timings = {'decode': decoded - start, 'transform': transformed - decoded, 'encode': encoded_at - transformed}
+    return None, pixels, timings
+
+
+def output_path(path, output_dir, suffix):
+    """
+    :param path: Path of the input image
+    :param output_dir: Directory of the output images
+    :param suffix: Appended to the name of the input image
+    :return: path: Path of the output image
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(output_dir, stem + suffix + extension)
+
+
+def run_batch(recipe, paths, output_dir, workers=None, suffix='', tile_above=None, log=print):
+    """
+    Applies a recipe on every image. Files are read ahead by a thread pool while the worker processes transform the
+    images, and the results are written by a separate thread. Images of more than tile_above megapixels are instead
+    converted to memory mapped files and transformed tile by tile by the workers, see process_large_image. A file
+    which cannot be processed is reported and skipped, the rest of the batch continues. This includes a file whose
+    worker process dies, e.g. killed for running out of memory: the pool is replaced and the other images in flight
+    are submitted again
+
+    :param recipe: List of steps
+    :param paths: Paths of the input images
+    :param output_dir: Directory of the output images
+    :param workers: Number of worker processes, the number of cores if None
+    :param suffix: Appended to the names of the output images
+    :param tile_above: Megapixels above which an image is transformed tile by tile, None to never tile
+    :param log: Called with every line of the report
+    :return: summary: Dict with the number of processed and failed images, the wall time and the throughput
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    window = 2 * workers    # Images in flight, so that the workers never wait for the disk
+    paths = iter(paths)
+    reads = deque()    # (path, future of the bytes) read ahead
+    jobs = deque()    # (path, function, args, future of the result) submitted to the workers
+    writes = []    # (path, number of pixels, future of the write)
+    done, failed, pixels = 0, 0, 0
+    start = time.perf_counter()
+
+    def replace_pool(broken):
+        """
+        Replaces a pool which lost a worker process. Every job in flight on it fails with BrokenProcessPool, so the
+        ones which had not finished are submitted again on the new pool
+
+        :param broken: The broken pool
+        :return: pool: The new pool
+        """
+        broken.shutdown(wait=False)
+        pool = ProcessPoolExecutor(max_workers=workers)
+        for i, (path, function, args, job) in enumerate(jobs):
+            if job.done() and not job.cancelled() and not isinstance(job.exception(), BrokenProcessPool):
+                continue    # Finished before the pool broke, its result is kept
+            jobs[i] = (path, function, args, pool.submit(function, *args))
+        return pool
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        with ThreadPoolExecutor(max_workers=window) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+            while True:
+                while len(reads) < window:    # Prefetch the next files
+                    path = next(paths, None)
+                    if path is None:
+                        break
+                    pixels_in_file = image_pixels(path) if tile_above is not None else None
+                    if pixels_in_file is not None and pixels_in_file > tile_above * 1e6:    # Never read whole
+                        reads.append((path, None))
+                    else:
+                        reads.append((path, reader.submit(read_file, path)))
+                while reads and len(jobs) < window:    # Keep the workers busy
+                    path, read = reads.popleft()
+                    try:
+                        if read is None:
+                            function = process_large_image
+                            args = (path, recipe, output_path(path, output_dir, suffix))
+                        else:
+                            function = process_image
+                            args = (read.result(), recipe, os.path.splitext(path)[1] or '.png')
+                        jobs.append((path, function, args, pool.submit(function, *args)))
+                    except BrokenProcessPool:    # A worker died, the pool is replaced once its job is collected
+                        reads.appendleft((path, read))
+                        if jobs:
+                            break
+                        pool = replace_pool(pool)
+                    except OSError as error:
+                        failed += 1
+                        log("%s: failed (%s)" % (path, error))
+                if not jobs:
+                    if reads:
+                        continue
+                    break
+
+                path, _, _, job = jobs.popleft()    # Results are collected in input order
+                try:
+                    encoded, n_pixels, timings = job.result()
+                except BrokenProcessPool:    # A worker process died, most likely running this job, the oldest one
+                    failed += 1
+                    log("%s: failed (the worker process died, e.g. out of memory)" % path)
+                    pool = replace_pool(pool)
+                    continue
+                except Exception as error:    # A bad file must not stop the batch
+                    failed += 1
+                    log("%s: failed (%s)" % (path, error))
+                    continue
+                if encoded is not None:    # Tiled images are written by their worker
+                    writes.append((path, n_pixels, writer.submit(write_file, output_path(path, output_dir, suffix),
+                                                                 encoded)))
+                done += 1
+                pixels += n_pixels
+                log("%s: ok, %.1f MP, decode %.0f ms, transform %.0f ms, encode %.0f ms" % (
+                    path, n_pixels/1e6, 1000 * timings['decode'], 1000 * timings['transform'],
+                    1000 * timings['encode']))
+
+            for path, n_pixels, write in writes:    # Report the files which could not be written
+                if write.exception() is not None:
+                    failed += 1
+                    done -= 1
+                    pixels -= n_pixels
+                    log("%s: write failed (%s)" % (path, write.exception()))
+    finally:
+        pool.shutdown()    # The current pool, which replace_pool may have swapped
+
+    elapsed = time.perf_counter() - start
+    summary = {'processed': done, 'failed': failed, 'seconds': elapsed,
+               'images_per_second': done/elapsed if elapsed else 0.0,
+               'megapixels_per_second': pixels/1e6/elapsed if elapsed else 0.0}
+    log("%d processed, %d failed in %.2f s: %.2f images/s, %.2f MP/s" % (
+        done, failed, elapsed, summary['images_per_second'], summary['megapixels_per_second']))
+    return summary
+
+
+def main(argv=None):
+    """
+    Command line entry point, e.g. python batch.py recipe.json "photos/*.jpg" -o edited --workers 8
+    """
+    parser = argparse.ArgumentParser(description="Apply an edit recipe to many images without the GUI")
+    parser.add_argument('recipe', help="JSON file with the list of steps to apply")
+    parser.add_argument('inputs', nargs='+', help="Input images or glob patterns")
+    parser.add_argument('-o', '--output-dir', required=True, help="Directory in which the results are written")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--suffix', default='', help="Appended to the names of the output images")
+    parser.add_argument('--tile-above', type=float, default=None, help="Megapixels above which images are "
+                        "transformed tile by tile from memory mapped files (blur, sharpen and edge steps only)")
+    args = parser.parse_args(argv)
+
+    try:
+        recipe = load_recipe(args.recipe)
+    except (OSError, ValueError) as error:    # Reported before any worker starts
+        parser.error("%s: %s" % (args.recipe, error))
+    paths = sorted(path for pattern in args.inputs for path in (glob.glob(pattern) or [pattern]))
+    summary = run_batch(recipe, paths, args.output_dir, workers=args.workers, suffix=args.suffix,
+                        tile_above=args.tile_above)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':    # If this file is run on the terminal
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))    # The repo root, where main.py lives
+BUDGET = 0.5    # Seconds the import of the GUI may take before the window can be created
+HEAVY_MODULES = ('numpy', 'cv2', 'PIL', 'skimage', 'scipy', 'image_transforms.pipeline')    # Must stay off the
+# startup path, they are loaded in the background once the window is shown
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(repr((elapsed, [name for name in %r if name in sys.modules])))
+""" % (HEAVY_MODULES,)
+
+
+def measure(repeats):
+    """
+    Imports the GUI in fresh interpreters, so that every run pays the full import cost
+
+    :param repeats: Number of interpreters started
+    :return: (times, loaded): Import times in seconds and the heavy modules loaded by the import
+    """
+    times, loaded = [], set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, check=True, capture_output=True,
+                                text=True).stdout
+        elapsed, modules = ast.literal_eval(output.strip().splitlines()[-1])
+        times.append(elapsed)
+        loaded.update(modules)
+    return times, sorted(loaded)
+
+
+def slowest_imports(n=10):
+    """
+    :param n: Number of modules
+    :return: imports: The n (cumulative microseconds, module) imports of the GUI which take the longest, from the
+     output of python -X importtime
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main(argv=None):
+    """
+    Command line entry point, e.g. python benchmarks/bench_startup.py --budget 0.5. Exits with 1 if the import of
+    the GUI takes longer than the budget or loads a heavy module
+    """
+    parser = argparse.ArgumentParser(description="Check the startup time of the GUI against a budget")
+    parser.add_argument('--repeats', type=int, default=5, help="Fresh interpreters started, the median is kept")
+    parser.add_argument('--budget', type=float, default=BUDGET, help="Largest accepted import time in seconds")
+    parser.add_argument('-o', '--output', default=None, help="JSON file the results are written to")
+    args = parser.parse_args(argv)
+
+    times, loaded = measure(args.repeats)
+    median = statistics.median(times)
+    for micros, name in slowest_imports():
+        print("%8.1f ms  %s" % (micros/1000.0, name))
+    print("import main: median %.1f ms, max %.1f ms, budget %.0f ms" % (1000 * median, 1000 * max(times),
+                                                                       1000 * args.budget))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'times': times, 'median': median, 'budget': args.budget, 'heavy_modules': loaded}, f, indent=2)
+
+    failed = False
+    if median > args.budget:
+        print("FAILED: the import takes longer than the budget")
+        failed = True
+    if loaded:
+        print("FAILED: heavy modules imported at startup: %s" % ', '.join(loaded))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':    # If this file is run on the terminal
+    sys.exit(main())
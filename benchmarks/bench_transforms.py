@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))    # Run from anywhere in the repo
+
+from image_transforms import blur, convolution, edge_detector, equalisation, gamma, log_transform, sharpen
+
+SIZES = (256, 512, 1024, 2048, 4096, 8192)    # Sides of the square synthetic images
+SEED = 610    # Seed of the synthetic images, so every run measures the same pixels
+TOLERANCE = 0.10    # Relative slowdown or memory growth reported as a regression
+
+
+def synthetic_image(size, kind):
+    """
+    Creates a reproducible test image: smooth gradients plus noise, so that histograms and edges are not degenerate
+
+    :param size: Side of the square image
+    :param kind: 'bgr' for a float32 colour image, 'bgr_u8' for an 8 bit colour image as loaded by the GUI, 'gray' for
+     a float32 channel, 'gray_u8' for an 8 bit channel
+    :return: img: Synthetic image
+    """
+    rng = np.random.default_rng(SEED)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)/size
+    channels = 3 if kind.startswith('bgr') else 1
+    img = np.stack([(x * (c + 1) + y * (channels - c)) % 1.0 for c in range(channels)], axis=-1) * 200
+    img += rng.normal(0, 20, img.shape)
+    img = np.clip(img, 0, 255).astype(np.float32)
+    if not kind.startswith('bgr'):
+        img = img[:, :, 0]
+    return img.astype(np.uint8) if kind.endswith('_u8') else img
+
+
+def kernel(size):
+    """
+    :param size: Side of the square kernel
+    :return: kernel: Reproducible non separable kernel
+    """
+    return np.random.default_rng(SEED).random((size, size))
+
+
+# (name, input kind, function, list of parameter dicts). The parameters cover the ranges of the ToolBar sliders
+CASES = [
+    ('convolution', 'gray', lambda img, k: convolution.convolution(img, kernel(k)), [{'k': 3}, {'k': 9}, {'k': 31}]),
+    ('gaussian_blur', 'bgr', blur.gaussian_blur, [{'std': 1.0}, {'std': 5.0}, {'std': 20.0}, {'std': 100.0}]),
+    ('gaussian_blur[uint8]', 'bgr_u8', blur.gaussian_blur, [{'std': 5.0}, {'std': 20.0}]),
+    ('histogram_eq', 'gray', equalisation.histogram_eq, [{}]),
+    ('local_histogram_eq', 'gray_u8', equalisation.local_histogram_eq,
+     [{'window': 7}, {'window': 128}, {'window': 128, 'clip_limit': 3.0}]),
+    ('gamma_correct', 'gray', gamma.gamma_correct, [{'gamma': 0.5}, {'gamma': 1.5}, {'gamma': 3.0}]),
+    ('gamma_correct[uint8]', 'gray_u8', gamma.gamma_correct, [{'gamma': 1.5}]),
+    ('log_trans', 'gray', log_transform.log_trans, [{}]),
+    ('log_trans[uint8]', 'gray_u8', log_transform.log_trans, [{}]),
+    ('gaussian_unsharp_masking', 'bgr', sharpen.gaussian_unsharp_masking,
+     [{'std': 2.0, 'c': 0.5}, {'std': 20.0, 'c': 0.5}]),
+    ('gaussian_unsharp_masking[uint8]', 'bgr_u8', sharpen.gaussian_unsharp_masking, [{'std': 2.0, 'c': 0.5}]),
+    ('thresholded_unsharp_masking', 'bgr', sharpen.thresholded_unsharp_masking,
+     [{'std': 2.0, 'c': 0.5, 'threshold': 10.0}]),
+    ('edge_detector', 'gray', edge_detector.edge_detector, [{'threshold': 50.0}, {'threshold': 200.0}]),
+]
+
+
+def reset_caches():
+    """
+    Drops the results cached by the transforms, so that every repeat measures a full computation
+    """
+    edge_detector._gradient_cache.clear()
+
+
+def measure(function, img, params, repeats):
+    """
+    Measures one transform on one image
+
+    :param function: Transform
+    :param img: Input image
+    :param params: Parameters of the transform
+    :param repeats: Number of timed runs
+    :return: result: Dict with the min and median wall time in seconds, the peak of the memory allocated during a run
+     in bytes, that peak in multiples of the input size, i.e. how many full size temporaries are alive at once, and
+     the number of memory blocks allocated during a run which are still held when it returns: the result, and
+     anything the transform keeps such as cached gradients. Blocks freed before the run returns are not counted, the
+     peak is the measure of the temporaries
+    """
+    times = []
+    for _ in range(repeats):
+        reset_caches()
+        start = time.perf_counter()
+        function(img, **params)
+        times.append(time.perf_counter() - start)
+
+    reset_caches()
+    tracemalloc.start()    # NumPy reports its buffers to tracemalloc, so this sees the image temporaries
+    before = tracemalloc.take_snapshot()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = function(img, **params)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    statistics_diff = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+    retained = sum(stat.count_diff for stat in statistics_diff if stat.count_diff > 0)
+    tracemalloc.stop()
+    del result
+    return {'time_min': min(times), 'time_median': statistics.median(times), 'peak_bytes': peak,
+            'peak_copies': peak/float(img.nbytes), 'retained_blocks': retained}
+
+
+def run(sizes, repeats, names=None, log=print):
+    """
+    Runs every benchmark case on every image size
+
+    :param sizes: Sides of the synthetic images
+    :param repeats: Number of timed runs per measurement
+    :param names: Names of the cases to run, all if None
+    :param log: Called with a line per measurement
+    :return: report: Dict with the environment and the list of results
+    """
+    results = []
+    for size in sizes:
+        images = {}
+        for name, kind, function, param_sets in CASES:
+            if names and name not in names:
+                continue
+            if kind not in images:
+                images[kind] = synthetic_image(size, kind)
+            for params in param_sets:
+                result = dict(name=name, size=size, params=params, **measure(function, images[kind], params, repeats))
+                results.append(result)
+                log("%-32s %5d  %-24s %9.4f s  %8.1f MB  %5.1fx  %6d retained" % (
+                    name, size, json.dumps(params, sort_keys=True), result['time_min'], result['peak_bytes']/1e6,
+                    result['peak_copies'], result['retained_blocks']))
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cores': os.cpu_count(), 'repeats': repeats, 'sizes': list(sizes)}
+    return {'meta': meta, 'results': results}
+
+
+def result_key(result):
+    """
+    :param result: One measurement
+    :return: key: Identifies the same measurement across reports
+    """
+    return result['name'], result['size'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(report, baseline, tolerance=TOLERANCE, log=print):
+    """
+    Compares a report against a baseline report and lists the measurements that got slower, use more memory or
+    retain more blocks
+
+    :param report: New report
+    :param baseline: Baseline report
+    :param tolerance: Relative growth which is accepted
+    :param log: Called with a line per regression
+    :return: regressions: List of (key, metric, baseline value, new value)
+    """
+    old = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        reference = old.get(result_key(result))
+        if reference is None:
+            continue
+        for metric in ('time_min', 'peak_bytes', 'retained_blocks'):
+            if metric not in reference:    # Baseline older than the metric
+                continue
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((result_key(result), metric, reference[metric], result[metric]))
+                log("REGRESSION %s %d %s: %s %.4g -> %.4g (%+.0f%%)" % (
+                    result['name'], result['size'], result_key(result)[2], metric, reference[metric], result[metric],
+                    100.0 * (result[metric]/reference[metric] - 1) if reference[metric] else float('inf')))
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point, e.g.
+    python benchmarks/bench_transforms.py --sizes 256 1024 -o baseline.json
+    python benchmarks/bench_transforms.py --sizes 256 1024 -o new.json --compare baseline.json
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the image transforms on synthetic images")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="Sides of the synthetic images")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs per measurement, the minimum is kept")
+    parser.add_argument('--only', nargs='+', default=None, help="Names of the transforms to benchmark")
+    parser.add_argument('-o', '--output', default=None, help="JSON file the results are written to")
+    parser.add_argument('--compare', default=None, help="Baseline JSON file to check the results against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="Relative growth flagged as regression")
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.repeats, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        print("%d regressions against %s" % (len(regressions), args.compare))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':    # If this file is run on the terminal
+    sys.exit(main())
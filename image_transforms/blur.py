@@ -1,28 +1,125 @@
 import numpy as np
-from convolution import convolution
-from scipy import signal
+import cv2
+from image_transforms.convolution import batch_convolution
+from image_transforms.storage import working
 
+KERNEL_RADIUS_STDS = 3    # Radius of the gaussian kernel in multiples of the std. Covers 99.7% of the distribution
+BOX_BLUR_MIN_STD = 6.0    # From this std onwards, the gaussian is approximated using repeated box filters. Measured
+# on step edges against a gaussian truncated at 6 stds, the box filters are at most 0.85 grey levels off for stds
+# of 6 to 100, and the kernel at most 0.44 below 6. Below 6 the boxes are too narrow, e.g. 1.5 levels off at std 5
+BOX_BLUR_PASSES = 12    # Number of box filters used to approximate the gaussian. Three boxes are 2 to 5 grey levels
+# off at every std, the error of the approximation only shrinks with the number of passes. Twelve passes of the
+# running sums still take about a quarter of the time of the kernel at std 6
 
-def gaussian_blur(img, std):
+
+def gaussian_kernel(std):
+    """
+    Creates a normalised 2D gaussian kernel whose radius is KERNEL_RADIUS_STDS times the std
+
+    :param std: Standard Deviation of kernel
+    :return: kernel: Gaussian kernel of size (2*radius + 1) x (2*radius + 1)
     """
-    Performs gaussian blurring on the input image with a kernel having std as passed in the function
+    radius = max(1, int(np.ceil(KERNEL_RADIUS_STDS * std)))    # Half size of the kernel, at least a 3x3 kernel
+    x = np.arange(-radius, radius + 1)    # Distances of the kernel taps from the centre of the kernel
+    profile = np.exp(-x**2/(2 * std ** 2))    # 1D gaussian distribution centred at the centre of the kernel
+    kernel = np.outer(profile, profile)    # The 2D gaussian is the product of two 1D gaussians
+    return kernel/kernel.sum()    # Normalising so that the blurred image keeps the brightness of the input
+
+
+def box_sizes(std, passes=BOX_BLUR_PASSES):
+    """
+    Computes the widths of the box filters whose repeated application approximates a gaussian with the given std
+
+    :param std: Standard Deviation of the gaussian
+    :param passes: Number of box filters
+    :return: sizes: List of odd box widths, one per pass
+    """
+    ideal = np.sqrt(12 * std ** 2/passes + 1)    # Width giving the exact variance if all boxes had the same width
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:    # Boxes need to have odd widths so that they are centred on the pixel
+        lower -= 1
+    upper = lower + 2
+    n_lower = int(round((12 * std ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes)/(-4 * lower - 4)))
+    # Number of boxes with the lower width so that the total variance matches std**2
+    return [lower if i < n_lower else upper for i in range(passes)]
+
+
+def box_filter(img, size, axis=None, out=None):
+    """
+    Box filters the image with OpenCV, which keeps a running sum of the pixels entering and leaving the box. Cost per
+    pixel does not depend on the box size, and the borders are reflected without padding a copy of the image
 
     :param img: Input image
+    :param size: Odd width of the box
+    :param axis: Axis along which the image is filtered, None to filter along both the spatial axes
+    :param out: Optional preallocated float32 output of the shape of the image. May be the input image itself
+    :return: output: Box filtered float32 image
+    """
+    if img.dtype not in (np.uint8, np.float32):    # The dtypes OpenCV filters straight into float32
+        img = working(img).astype(np.float32, copy=False)
+    ksize = (size if axis != 0 else 1, size if axis != 1 else 1)    # OpenCV sizes are (width, height)
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    cv2.boxFilter(img, cv2.CV_32F, ksize, dst=out, borderType=cv2.BORDER_REFLECT_101)    # Reflection without
+    # repeating the border pixel, like mode='reflect' of np.pad
+    return out
+
+
+def box_blur(img, std, out=None):
+    """
+    Approximates gaussian blurring by applying repeated box filters along the rows and columns of the image
+
+    :param img: Input image
+    :param std: Standard Deviation of the gaussian
+    :param out: Optional preallocated float32 output of the shape of the image. May be the input image itself
+    :return: output: Output smoothened float32 image
+    """
+    output = img
+    for size in box_sizes(std):    # Every pass filters the image along both the spatial axes, in place after the
+        # first one
+        output = box_filter(output, size, out=out)
+        out = output
+    return output
+
+
+def blur_radius(std):
+    """
+    Number of neighbouring pixels on each side that gaussian_blur reads to compute one output pixel. Used to size the
+    halos when the image is processed tile by tile
+
+    :param std: Standard Deviation of kernel
+    :return: radius: Radius of the support of the blur
+    """
+    if std <= 0:
+        return 0
+    if std >= BOX_BLUR_MIN_STD:    # Every box filter widens the support by half its width
+        return sum(size//2 for size in box_sizes(std))
+    return gaussian_kernel(std).shape[0]//2
+
+
+def gaussian_blur(img, std, out=None):
+    """
+    Performs gaussian blurring on the input image with a kernel having std as passed in the function. The kernel is
+    sized from the std, and large stds are approximated with box filters so that the cost does not grow with the std.
+    The result is computed directly into a float32 buffer, so the output is the only full size float allocation
+
+    :param img: Input image, of any dtype
     :param std: Standard Deviation of kernel
+    :param out: Optional preallocated float32 output of the shape of the image. May be the input image itself, which
+     is then blurred in place
     :return: output: Output smoothened image
     """
-    kernel = np.zeros((5, 5))    # Gaussian kernel of 5x5 size
-    m = 2    # m = kernel_height//2 for iteration
-    n = 2    # n = kernel_width//2 for iteration
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
 
-    for x in range(-m, m+1):    # Iterating over the rows of the kernel
-        for y in range(-n, n+1):    # Iterating over the columns of the kernel
-            kernel[m+x, n+y] = np.exp(-(x**2 + y**2)/(2 * std ** 2))/np.sqrt(2 * np.pi * (std ** 2))  # Calculating the
-            # kernel value at location [m+x, n+y] using the gaussian distribution centred at the centre of the kernel
-            # and having std equivalent to the one passed in the function
+    if std <= 0:    # A gaussian with zero std does not change the image
+        out[...] = img
+        return out
 
-    output = np.zeros_like(img, dtype = np.float32)    # output image matrix
+    if std >= BOX_BLUR_MIN_STD:    # The kernel would be too large, so the constant time approximation is used
+        return box_blur(img, std, out=out)
 
-    for i in range(3):    # Iterating over all the channels of the output image
-        output[:,:,i] = convolution(img[:,:,i], kernel)    # Performing gaussian convolution over each channel
-    return output    # Returning the gaussian blurred image.
+    kernel = gaussian_kernel(std)    # Gaussian kernel sized according to the std
+    batch_convolution(img, kernel, out=out[..., None])    # Performing gaussian convolution over all the channels at
+    # once, straight into the output
+    return out    # Returning the gaussian blurred image.
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_BUDGET = 512 * 1024 ** 2    # Bytes of results kept by the shared cache
+
+
+def image_digest(img):
+    """
+    Content hash of an image. Equal images give equal digests whichever array holds them
+
+    :param img: Input image
+    :return: digest: Hex digest of the shape, dtype and pixels of the image
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((img.shape, img.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+class TransformCache(object):
+    """
+    Memoizes transforms on the content of their input image. Results are keyed on the transform name, the digest of
+    the input and the parameters, and the least recently used results are evicted once their total size exceeds the
+    budget. Cached results are read only, since they are shared by every caller
+    """
+    def __init__(self, budget=DEFAULT_BUDGET):
+        """
+        :param budget: Maximum number of bytes of results kept. 0 disables caching
+        """
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0    # Bytes of results currently held
+        self._entries = OrderedDict()    # key -> result, least recently used first
+        self._lock = threading.Lock()    # Transforms run on worker threads
+
+    def call(self, name, function, img, **params):
+        """
+        Returns function(img, **params), computing it only if the same call on the same pixels is not cached
+
+        :param name: Name of the transform, part of the key
+        :param function: Transform taking the image as first argument
+        :param img: Input image
+        :param params: Parameters of the transform, part of the key
+        :return: result: Output of the transform
+        """
+        if self.budget <= 0:
+            return function(img, **params)
+
+        key = (name, image_digest(img), tuple(sorted(params.items())))
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)    # Mark as most recently used
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = function(img, **params)
+        if isinstance(result, np.ndarray) and result.nbytes <= self.budget:
+            result.flags.writeable = False    # Callers must not change the shared result
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = result
+                    self.nbytes += result.nbytes
+                    self._evict()
+        return result
+
+    def stats(self):
+        """
+        :return: stats: Dict with the hit, miss and eviction counters, the number of entries and their size in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def clear(self):
+        """
+        Removes every result and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _evict(self):
+        """
+        Removes the least recently used results until the budget is met. Called with the lock held
+        """
+        while self.nbytes > self.budget and self._entries:
+            _, result = self._entries.popitem(last=False)
+            self.nbytes -= result.nbytes
+            self.evictions += 1
+
+
+default_cache = TransformCache()    # Shared by the GUI and the headless callers
@@ -1,19 +1,292 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from skimage.util.shape import view_as_windows
+from image_transforms.instrument import stage
 
+FFT_MIN_TAPS = 15 * 15    # Non-separable kernels with at least this many taps are convolved in the frequency domain
+FFT_MIN_SEPARABLE_SIZE = 63    # Separable kernels longer than this along an axis are also convolved using the FFT
+SEPARABLE_TOLERANCE = 1e-10    # Relative size of the second singular value below which a kernel counts as separable
+MAX_SEPARABLE_RANK = 2    # Kernels which are a sum of up to this many separable kernels, such as the unsharp masking
+# kernel, are also applied as 1D passes
+BACKENDS = ('auto', 'direct', 'separable', 'fft')    # The backends which can be requested by the caller
+MIN_BAND_ROWS = 64    # Bands smaller than this are not worth the scheduling overhead of a thread
+SEPARABLE_CHUNK_ROWS = 64    # Rows computed at once by the separable backend, bounds the size of its temporaries
 
-def convolution(img, kernel):
+
+def available_cores():
+    """
+    :return: cores: Number of cores this process is allowed to run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def low_rank_factors(kernel, max_rank=MAX_SEPARABLE_RANK, tol=SEPARABLE_TOLERANCE):
+    """
+    Decomposes a 2D kernel into a sum of separable kernels, i.e. outer products of a column and a row vector, using
+    its singular values. A kernel of rank r can be applied as r pairs of 1D passes
+
+    :param kernel: Convolution kernel
+    :param max_rank: Largest number of separable kernels accepted
+    :param tol: Relative tolerance on the singular values, smaller ones are treated as zero
+    :return: terms: List of (column, row) 1D kernels such that the sum of their outer products is the kernel, or None
+     if the kernel needs more than max_rank of them
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.ndim != 2 or not kernel.any():    # A zero kernel has no meaningful decomposition
+        return None
+
+    u, s, vt = np.linalg.svd(kernel)
+    rank = int(np.count_nonzero(s > tol * s[0]))    # Singular values which are not negligible
+    if rank > max_rank:
+        return None
+    return [(u[:, i] * np.sqrt(s[i]), vt[i] * np.sqrt(s[i])) for i in range(rank)]    # Split every singular value
+    # equally between both the vectors
+
+
+def separate_kernel(kernel, tol=SEPARABLE_TOLERANCE):
+    """
+    Checks whether a 2D kernel is separable, i.e. it is the outer product of a column and a row vector. Gaussian and
+    Sobel kernels are separable and can be applied as two 1D passes instead of one 2D pass
+
+    :param kernel: Convolution kernel
+    :param tol: Relative tolerance on the second singular value of the kernel
+    :return: (column, row) 1D kernels such that np.outer(column, row) == kernel, or None if kernel is not separable
+    """
+    terms = low_rank_factors(kernel, 1, tol)    # A kernel is separable iff it has rank 1
+    return None if terms is None else terms[0]
+
+
+def select_backend(kernel_shape, rank=None):
+    """
+    Chooses the cheapest backend for a kernel of the given shape
+
+    :param kernel_shape: (height, width) of the kernel
+    :param rank: Number of separable kernels the kernel is the sum of, None if it is not a sum of few of them
+    :return: backend: One of 'direct', 'separable' or 'fft'
+    """
+    h, w = kernel_shape
+    if rank:    # 1D passes cost rank*(h + w) taps per pixel, which is cheaper than the FFT unless the kernel is huge
+        if max(h, w) > FFT_MIN_SEPARABLE_SIZE:
+            return 'fft'
+        if rank == 1 or rank * (h + w) < h * w:
+            return 'separable'
+    return 'fft' if h * w >= FFT_MIN_TAPS else 'direct'    # h*w taps per pixel for direct vs O(log n) for the FFT
+
+
+def _pad(img, kernel_shape):
+    """
+    Reflection pads the spatial axes of the image so that a 'valid' convolution with the kernel gives back an image
+    of the input size. Channel axes are not padded
+
+    :param img: Input image of shape HxW or HxWxC
+    :param kernel_shape: (height, width) of the kernel
+    :return: padded_img: Padded image
+    """
+    h, w = kernel_shape
+    pad_width = [((h-1)//2, h//2), ((w-1)//2, w//2)] + [(0, 0)] * (img.ndim - 2)
+    return np.pad(img, pad_width, mode='reflect')
+
+
+def _direct(padded_img, kernels, out):
+    """
+    Window based convolution, every kernel is multiplied with every window of the padded image. All the channels and
+    kernels share one window view and are computed in a single contraction
+
+    :param padded_img: Reflection padded image of shape HxWxC
+    :param kernels: Stack of kernels of shape Kxhxw
+    :param out: Output convolved images of shape HxWxCxK, written in place
+    """
+    _, h, w = kernels.shape
+    sub_matrices = view_as_windows(padded_img, (h, w, padded_img.shape[2]), 1)[:, :, 0]   # break the padded image
+    # into windows that are of the same size as the kernel with stride = 1
+    np.einsum('nij,klijc->klcn', kernels, sub_matrices, out=out)  # This multiplies the windows with the kernels
+    # elementwise and adds the resultant elements of the matrix to give the output convolved images
+
+
+def _separable(padded_img, factors, out):
+    """
+    Convolution with sums of separable kernels. Every separable term is a vertical pass with the column vector
+    followed by a horizontal pass with the row vector, accumulated into the output. Every pass accumulates shifted
+    slices of the image, so no window tensor is created. The rows are processed in chunks of SEPARABLE_CHUNK_ROWS, so
+    the temporaries are a few rows high whatever the image size
+
+    :param padded_img: Reflection padded image of shape HxWxC
+    :param factors: One list of (column, row) 1D kernels per kernel, see low_rank_factors
+    :param out: Output convolved images of shape HxWxCxK, written in place
+    """
+    out_h, out_w = out.shape[:2]    # Size of the output after the 'valid' convolution
+    factors = [[(column.astype(out.dtype), row.astype(out.dtype)) for column, row in terms] for terms in factors]
+    # The taps are in the precision of the output, so that the products are not promoted
+    kernel_h = len(factors[0][0][0])
+
+    for y0 in range(0, out_h, SEPARABLE_CHUNK_ROWS):
+        y1 = min(out_h, y0 + SEPARABLE_CHUNK_ROWS)
+        rows = padded_img[y0:y1 + kernel_h - 1]    # Input rows read by this chunk of output rows
+        vertical = np.empty((y1 - y0,) + padded_img.shape[1:], dtype=out.dtype)    # Output of the vertical pass
+        product = np.empty_like(vertical)    # Contribution of one tap, reused by all the taps
+        for n, terms in enumerate(factors):
+            horizontal = out[y0:y1, ..., n]    # The horizontal passes write directly into the output
+            filled = False    # Whether the output already holds the contribution of a tap
+            for column, row in terms:
+                vertical_filled = False
+                for i, tap in enumerate(column):    # Adding the contribution of every row of the kernel
+                    if tap:
+                        _accumulate(vertical, rows[i:i + y1 - y0], tap, product, vertical_filled)
+                        vertical_filled = True
+                if not vertical_filled:    # A zero column contributes nothing
+                    continue
+
+                for j, tap in enumerate(row):    # Adding the contribution of every column of the kernel
+                    if tap:
+                        _accumulate(horizontal, vertical[:, j:j + out_w], tap, product[:, :out_w], filled)
+                        filled = True
+            if not filled:
+                horizontal[...] = 0
+
+
+def _accumulate(target, source, tap, product, add):
+    """
+    Adds the contribution of one tap to a partial sum. The first tap is written directly, which saves zeroing the
+    partial sum and one pass over it
+
+    :param target: Partial sum, written in place
+    :param source: Shifted slice of the input of the pass
+    :param tap: Weight of the tap
+    :param product: Scratch buffer of the shape of the target
+    :param add: Whether the target already holds a partial sum
+    """
+    if add:
+        np.multiply(source, tap, out=product)
+        target += product
+    else:
+        np.multiply(source, tap, out=target)
+
+
+def _fft(padded_img, kernels):
+    """
+    Convolution in the frequency domain. Cost per pixel does not depend on the size of the kernel. The spectrum of the
+    image is computed once and shared by all the kernels
+
+    :param padded_img: Reflection padded image of shape HxWxC
+    :param kernels: Stack of kernels of shape Kxhxw
+    :return: convoluted: Output convolved images of shape HxWxCxK
+    """
+    _, h, w = kernels.shape
+    fft_shape = padded_img.shape[:2]    # The padding already covers the wrap around of the kernel
+    padded_img = padded_img.astype(np.float64, copy=False)    # Single precision FFTs lose too much accuracy
+    img_spectrum = np.fft.rfft2(padded_img, fft_shape, axes=(0, 1))
+    kernel_spectra = np.fft.rfft2(kernels[:, ::-1, ::-1], fft_shape)   # The kernels are flipped as the other
+    # backends correlate the image with the kernel
+    spectrum = img_spectrum[..., None] * np.moveaxis(kernel_spectra, 0, -1)[:, :, None, :]
+    full = np.fft.irfft2(spectrum, fft_shape, axes=(0, 1))
+    return full[h-1:, w-1:]    # Only the part of the circular convolution without wrap around is kept
+
+
+def _banded(compute, padded_img, kernel_height, out, workers):
+    """
+    Splits the output into horizontal bands and computes them on a thread pool. Every band reads its rows of the
+    padded image plus a halo of kernel_height - 1 rows and writes into its slice of the output, so no copies are
+    made. Every output pixel is computed by the same operations as without bands, so the result is bit identical
+
+    :param compute: Backend called as compute(padded_band, out_band)
+    :param padded_img: Reflection padded image of shape HxWxC
+    :param kernel_height: Height of the kernels
+    :param out: Output convolved images, written in place
+    :param workers: Number of threads
+    """
+    out_h = out.shape[0]
+    n_bands = max(1, min(workers, out_h//MIN_BAND_ROWS))
+    if n_bands == 1:
+        compute(padded_img, out)
+        return
+
+    bounds = np.linspace(0, out_h, n_bands + 1).astype(int)    # Rows at which the bands start and end
+    with ThreadPoolExecutor(max_workers=n_bands) as pool:    # NumPy releases the GIL in its heavy loops
+        jobs = [pool.submit(compute, padded_img[y0:y1 + kernel_height - 1], out[y0:y1])
+                for y0, y1 in zip(bounds[:-1], bounds[1:])]
+        for job in jobs:
+            job.result()    # Raises the exceptions of the bands
+
+
+def batch_convolution(img, kernels, backend='auto', workers=None, out=None, factors=None):
     """
-    Performs vectorized convolution between image and kernel. It uses 'reflection' padding on the image
+    Convolves every channel of the image with every kernel of a stack. The image is padded once and all the outputs
+    are computed together, instead of padding and convolving once per channel and kernel. The direct and separable
+    backends split the image into bands which are computed in parallel
+
+    :param img: Input image of shape HxW or HxWxC
+    :param kernels: Convolution kernel of shape hxw or stack of kernels of shape Kxhxw
+    :param backend: 'auto' to choose the backend from the kernels, or one of 'direct', 'separable', 'fft' to force it
+    :param workers: Number of threads, the number of available cores if None. 1 disables the bands
+    :param out: Optional preallocated output of shape HxWxK or HxWxCxK. Its dtype is the precision of the computation,
+     e.g. float32 halves the memory of the default float64. It may share memory with the image, which is copied
+     when padded
+    :param factors: Optional precomputed separable terms of every kernel, as returned by low_rank_factors. Lets the
+     caller cache them, or give sparser terms than the singular value decomposition finds
+    :return: convoluted: Output convolved images of shape HxWxK or HxWxCxK
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown convolution backend '%s', expected one of %s" % (backend, ', '.join(BACKENDS)))
+
+    kernels = np.asarray(kernels)
+    if kernels.ndim == 2:    # A single kernel is a stack of one kernel
+        kernels = kernels[None]
+    gray = img.ndim == 2
+    if gray:    # A 2D image is treated as an image with one channel
+        img = img[:, :, None]
+        if out is not None:
+            out = out[:, :, None]
+    if out is not None and out.shape != img.shape + (len(kernels),):
+        raise ValueError("Output of shape %s expected, got %s" % (img.shape + (len(kernels),), out.shape))
+
+    padded_img = _pad(img, kernels.shape[1:])  # pad the image in such a way that dimension of output image equals
+    # dimension of input
+
+    if factors is None and backend in ('auto', 'separable'):
+        factors = [low_rank_factors(kernel) for kernel in kernels]
+        if any(f is None for f in factors):    # The separable backend is only used if every kernel is a sum of few
+            # separable kernels
+            factors = None
+    if backend == 'auto':
+        backend = select_backend(kernels.shape[1:], None if factors is None else max(len(f) for f in factors))
+
+    if backend == 'fft':    # The FFT couples all the rows, so it is not split into bands
+        with stage('convolution.fft'):
+            convoluted = _fft(padded_img, kernels)
+            if out is not None:
+                out[...] = convoluted
+                convoluted = out
+        return convoluted[:, :, 0] if gray else convoluted
+
+    if backend == 'separable':
+        if factors is None:
+            raise ValueError("Kernel is not separable")
+        dtype = np.result_type(padded_img.dtype, np.float64)
+        compute = lambda band, out: _separable(band, factors, out)
+    else:
+        dtype = np.result_type(padded_img.dtype, kernels.dtype)
+        if out is not None:
+            kernels = kernels.astype(out.dtype, copy=False)    # einsum computes in the precision of the output
+        compute = lambda band, out: _direct(band, kernels, out)
+
+    convoluted = np.empty(img.shape + (len(kernels),), dtype=dtype) if out is None else out    # Output shared by
+    # the bands
+    with stage('convolution.' + backend):
+        _banded(compute, padded_img, kernels.shape[1], convoluted, available_cores() if workers is None else workers)
+    return convoluted[:, :, 0] if gray else convoluted
+
+
+def convolution(img, kernel, backend='auto'):
+    """
+    Performs vectorized convolution between image and kernel. It uses 'reflection' padding on the image.
+    Separable kernels are applied as two 1D passes and large kernels are applied using the FFT
+
     :param img: Input 2D image
     :param kernel: Convolution kernel
+    :param backend: 'auto' to choose the backend from the kernel, or one of 'direct', 'separable', 'fft' to force it
     :return: convoluted: Output convolved image
     """
-    h, w = kernel.shape  # Get the height and width of kernel
-    padded_img = np.pad(img, (((h-1)//2, (h-1)//2), ((h-1)//2, (h-1)//2)), mode='reflect')  # pad the image
-    # in such a way that dimension of output image equals dimension of input
-    sub_matrices = view_as_windows(padded_img, (h,w), 1)   # break the padded image into windows that are of the same
-    # size as the kernel with stride = 1
-    convoluted = np.einsum('ij,klij->kl',kernel,sub_matrices)  # This multiplies the windows with the kernel elementwise
-    # and adds the resultant elements of the matrix to give the output convolved image
-    return convoluted   # Return the convolved image
+    return batch_convolution(img, kernel, backend)[..., 0]   # Return the convolved image
@@ -1,26 +1,114 @@
+import threading
+from collections import OrderedDict
 import numpy as np
-from convolution import convolution
+from image_transforms.cache import image_digest
+from image_transforms.convolution import batch_convolution
 
+GRADIENT_CACHE_BUDGET = 256 * 1024 ** 2    # Bytes of gradient maps kept, 12 bytes per pixel of a grayscale image
+_gradient_cache = OrderedDict()    # digest -> dict of cached gradient maps, least recently used first
+_gradient_cache_lock = threading.Lock()    # Transforms run on worker threads
 
-def edge_detector(img, threshold = 100):
-    """
-    Returns the image with Sobel Edge Detection algorithm applied
 
-    :param img: Input image
-    :param threshold: The threshold to be applied on the gradient values
-    :return: gradient_map: Edges detected of the input image
+def sobel_gradients(img):
     """
+    Computes the Sobel gradients of the image without caching them. The gradients are exact in float32 for 8 bit
+    images, so they take half the memory of float64
 
+    :param img: Input grayscale image
+    :return: (gradient_x, gradient_y): float32 gradients in X and Y direction
+    """
     gradient_kernel_x = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])    # Kernel giving derivative in X direction
     gradient_kernel_y = np.flip(gradient_kernel_x.T, axis=0)    # Kernel giving derivative in Y direction
 
-    gradient_x = convolution(img, gradient_kernel_x)    # Calculating gradient in X direction
-    gradient_y = convolution(img, gradient_kernel_y)    # Calculating gradient in Y direction
+    stacked = batch_convolution(img, np.stack([gradient_kernel_x, gradient_kernel_y]),
+                                out=np.empty(img.shape[:2] + (2,), dtype=np.float32))    # Calculating the gradients
+    # in X and Y direction together, so that the image is padded and traversed only once
+    return stacked[..., 0], stacked[..., 1]
 
+
+def gradients(img):
+    """
+    Computes the Sobel gradients of the image, or returns them from the cache if the same image was seen recently
+
+    :param img: Input image
+    :return: entry: Dict with the 'x' and 'y' gradients and the normalised 'magnitude'. The 'direction' is added to the
+     dict by gradient_direction the first time it is requested
+    """
+    key = image_digest(img)
+    with _gradient_cache_lock:
+        entry = _gradient_cache.get(key)
+        if entry is not None:
+            _gradient_cache.move_to_end(key)    # Mark as most recently used
+            return entry
+
+    gradient_x, gradient_y = sobel_gradients(img)
     gradient_mag = np.sqrt(np.square(gradient_x) + np.square(gradient_y))    # Calculating the pixelwise magnitude of
     # the gradient in the spatial domain
-    gradient_mag *= 255.0/gradient_mag.max()    # normalising the gradient so that its magnitude values lie in [0,255]
-    gradient_mag[gradient_mag >= threshold] = 255.0    # Hard thresholding the gradient using the input threshold value
-    gradient_mag[gradient_mag < threshold] = 0.0    # Hard thresholding
+    if gradient_mag.max() > 0:    # A flat image has no gradient to normalise
+        gradient_mag *= 255.0/gradient_mag.max()    # normalising the gradient so that its magnitude values lie in
+        # [0,255]
+
+    entry = {'x': gradient_x, 'y': gradient_y, 'magnitude': gradient_mag}
+    with _gradient_cache_lock:
+        _gradient_cache[key] = entry
+        _evict()
+    return entry
+
+
+def _evict():
+    """
+    Evicts the gradients of the least recently used images until the cache fits its budget. The most recent image is
+    always kept. The lock must be held
+    """
+    nbytes = sum(_entry_bytes(entry) for entry in _gradient_cache.values())
+    while nbytes > GRADIENT_CACHE_BUDGET and len(_gradient_cache) > 1:
+        nbytes -= _entry_bytes(_gradient_cache.popitem(last=False)[1])
+
+
+def _entry_bytes(entry):
+    """
+    :param entry: Dict of cached gradient maps
+    :return: nbytes: Number of bytes of the maps. The 'x' and 'y' gradients are the two halves of one array
+    """
+    return sum(array.nbytes for array in entry.values())
+
+
+def gradient_magnitude(img):
+    """
+    Magnitude of the gradient of the image, normalised to [0,255]
+
+    :param img: Input image
+    :return: gradient_mag: Normalised gradient magnitude
+    """
+    return gradients(img)['magnitude']
+
+
+def gradient_direction(img):
+    """
+    Direction of the gradient of the image, in radians in [-pi, pi]. Shares the cached gradients with the magnitude
+
+    :param img: Input image
+    :return: gradient_dir: Angle of the gradient at every pixel
+    """
+    entry = gradients(img)
+    if 'direction' not in entry:    # Computed only the first time it is needed
+        entry['direction'] = np.arctan2(entry['y'], entry['x'])    # float32, like the gradients
+        with _gradient_cache_lock:
+            _evict()
+    return entry['direction']
+
+
+def edge_detector(img, threshold = 100):
+    """
+    Returns the image with Sobel Edge Detection algorithm applied. The gradient magnitude is cached per image, so
+    changing only the threshold costs a single comparison
+
+    :param img: Input image
+    :param threshold: The threshold to be applied on the gradient values
+    :return: gradient_map: Edges detected of the input image
+    """
+    gradient_mag = gradient_magnitude(img)
+    gradient_map = np.where(gradient_mag >= threshold, 255.0, 0.0)    # Hard thresholding the gradient using the
+    # input threshold value
 
-    return gradient_mag    # Returning the thresholded edge map
+    return gradient_map    # Returning the thresholded edge map
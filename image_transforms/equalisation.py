@@ -1,21 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import cv2
+from image_transforms.convolution import available_cores
+from image_transforms.lut import LEVELS, apply_lut
+
+SLIDING_MAX_WINDOW = 15    # Largest window equalised exactly by ranking every pixel in its window, larger ones use
+# the tiles. The rank of a pixel must fit in 8 bits, i.e. SLIDING_MAX_WINDOW**2 < 256
+SLIDING_BAND_ROWS = 64    # Rows ranked at once by the exact equalisation, small enough for the counts to stay in cache
+BAND_ROWS = 256    # Rows interpolated at once by the tiled equalisation, bounds the size of its temporaries
+HISTOGRAM_BAND_PIXELS = 1 << 24    # Pixels counted by one cv2.calcHist call. It counts in float32, which is exact
+# up to 2**24
 
 
 def create_histogram(img_channel, bins = 256):
     """
-    Creates a histogram for the input image channel
+    Creates a histogram for the input image channel. The pixels are counted with cv2.calcHist, channel by channel
+    and band by band, without converting them to a temporary of 8 byte indices as np.bincount does
 
-    :param img: Input image channel
+    :param img: Input image channel, or image whose channels are counted together
     :param bins: Number of different pixel intensities
     :return: hist: Histogram of pixel intensities
     """
-    img_channel = img_channel.astype('uint8')    # Change the pixels datatype from float to int so that discrete values
-    # can be counted
-    hist = np.zeros(bins)  # This will be the histogram with size = number of bins. Initialised to all zeros
-
-    for i in img_channel:  # Iterating over all pixels of input channel
-        hist[i] += 1  # If pixel intensity is 'i' then corresponding frequency bin in
-        # histogram is incremented by 1
+    img_channel = img_channel.astype('uint8', copy=False)    # Change the pixels datatype from float to int so that
+    # discrete values can be counted
+    if bins != LEVELS:
+        return np.bincount(img_channel.ravel(), minlength=bins)
+    hist = np.zeros(bins, dtype=np.int64)    # hist[i] is the number of pixels with intensity 'i'
+    if img_channel.ndim == 1:
+        img_channel = img_channel[np.newaxis]
+    channels = img_channel.shape[2] if img_channel.ndim == 3 else 1
+    band = max(1, HISTOGRAM_BAND_PIXELS // max(img_channel.shape[1], 1))    # Rows counted per call
+    for start in range(0, img_channel.shape[0], band):
+        band_img = np.ascontiguousarray(img_channel[start:start + band])
+        for channel in range(channels):
+            hist += cv2.calcHist([band_img], [channel], None, [bins], [0, bins]).ravel().astype(np.int64)
 
     return hist  # Return the output (histogram)
 
@@ -24,19 +42,23 @@ def cumulative_hist(histogram):
     """
     Creates a cumulative histogram out of the input histogram (equalisation)
 
-    :param histogram: Input histogram
-    :return: cum: Cumulative histogram
+    :param histogram: Input histogram, or stack of histograms along the last axis
+    :return: cum: Cumulative histogram, or stack of cumulative histograms
     """
-    cum = [histogram[0]]                   # initializing the list which will hold the cumulative frequencies
+    cum = np.cumsum(histogram, axis=-1)    # cum[i] = histogram[0] + histogram[1] + .. + histogram[i]
+    rnge = np.maximum(cum[..., -1:] - cum[..., :1], 1)    # Number of pixels above the darkest intensity
+    cum = ((cum - cum[..., :1]) * (histogram.shape[-1] - 1))/rnge  # normalizing the histogram to [0, bins - 1]
+    return cum                            # Return the normalized cumulative histogram
 
-    for i in range(1, len(histogram)):
-        cum.append(histogram[i] + cum[-1])  # cum[i] = histogram[0] + histogram[1] + .. + histogram[i]
-        # Hence cum[i] = cum[i-1] + histogram[i]
 
-    cum = np.array(cum)                   # Cast the list to an array
-    rnge = np.max(cum) - np.min(cum)              # Total number of pixels in image
-    cum = (cum * (len(histogram) - 1))/rnge  # normalizing the histogram
-    return cum                            # Return the normalized cumulative histogram
+def equalisation_lut(histogram):
+    """
+    Lookup table which equalises an image having the input histogram
+
+    :param histogram: Histogram of the image
+    :return: lut: 8 bit lookup table
+    """
+    return cumulative_hist(histogram).astype('uint8')    # Cumulative histogram cast to int
 
 
 def histogram_eq(img):
@@ -46,11 +68,173 @@ def histogram_eq(img):
     :param img: Input image
     :return: equalized_img: Equalised image
     """
-    flattened_img = img.flatten().astype('uint8')   # Image is flattened to one dimension and pixels converted to int
-    # to create histogram
+    img = img.astype('uint8', copy=False)   # Pixels converted to int to create histogram
     histogram = create_histogram(img)   # Histogram created by using above function
-    cumulative_histogram = cumulative_hist(histogram).astype('uint8')   # Cumulative histogram created and cast to int
-    transformed_img = cumulative_histogram[flattened_img]   # image transformed using the equalized histogram values
-    equalized_img = np.reshape(transformed_img, img.shape)   # Reshape the flattened image to original shape
+    equalized_img = apply_lut(img, equalisation_lut(histogram))   # image transformed using the equalized histogram
+    # values
 
     return equalized_img   # Return the equalized image
+
+
+def sliding_equalisation(img_channel, window, workers=None):
+    """
+    Local histogram equalisation: every pixel is equalised with the histogram of the window centred on it. Only one
+    value of the cumulative histogram is needed per pixel, its rank in the window, so instead of building histograms
+    the whole channel is compared with each of its window*window shifted copies and the comparisons are counted in
+    8 bits. The image is split into bands of SLIDING_BAND_ROWS rows which are ranked on a thread pool
+
+    :param img_channel: Input image channel
+    :param window: Odd side of the square window, at most SLIDING_MAX_WINDOW
+    :param workers: Number of threads, the number of available cores if None
+    :return: equalized_img: Equalised channel, the same as equalising every pixel with cumulative_hist of its window
+    """
+    if window > SLIDING_MAX_WINDOW:
+        raise ValueError("Windows larger than %d pixels use tiled_equalisation, got %d" % (SLIDING_MAX_WINDOW, window))
+    img_channel = img_channel.astype('uint8', copy=False)
+    h, w = img_channel.shape
+    radius = window//2
+    size = 2 * radius + 1
+    padded = np.pad(img_channel, radius, mode='reflect')
+    equalized_img = np.empty_like(img_channel)
+
+    def rank_band(y0, y1):
+        centre = img_channel[y0:y1]
+        below = np.zeros(centre.shape, dtype=np.uint8)    # Pixels of the window which are not brighter than the centre
+        for dy in range(size):
+            rows = padded[y0 + dy:y1 + dy]
+            for dx in range(size):
+                np.subtract(below, cv2.compare(rows[:, dx:dx + w], centre, cv2.CMP_LE), out=below)    # The
+                # comparison is 255 where true, subtracting it adds 1 modulo 256
+        zeros = cv2.integral((padded[y0:y1 + 2 * radius] == 0).view(np.uint8))    # Black pixels of every window, from
+        # the summed area table
+        zeros = zeros[size:, size:] - zeros[:-size, size:] - zeros[size:, :-size] + zeros[:-size, :-size]
+        equalized_img[y0:y1] = ((below - zeros) * (LEVELS - 1))//np.maximum(size * size - zeros, 1)    # Same formula
+        # as cumulative_hist, truncated like equalisation_lut
+
+    bands = [(y0, min(h, y0 + SLIDING_BAND_ROWS)) for y0 in range(0, h, SLIDING_BAND_ROWS)]
+    workers = min(len(bands), available_cores() if workers is None else workers)
+    if workers <= 1:
+        for band in bands:
+            rank_band(*band)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:    # OpenCV and NumPy release the GIL in their loops
+            for job in [pool.submit(rank_band, *band) for band in bands]:
+                job.result()    # Raises the exceptions of the bands
+    return equalized_img
+
+
+def tile_histograms(img_channel, tile):
+    """
+    Histograms of the square tiles of an image channel, counted in one pass
+
+    :param img_channel: Input 8 bit image channel
+    :param tile: Side of the tiles
+    :return: histograms: Array of shape (tile rows, tile columns, bins)
+    """
+    h, w = img_channel.shape
+    ny, nx = -(-h//tile), -(-w//tile)
+    histograms = np.zeros((ny, nx * LEVELS), dtype=np.int64)
+    column_offsets = (np.arange(w)//tile * LEVELS).astype(np.int32)    # Offset of the histogram of every column
+    for i, y0 in enumerate(range(0, h, tile)):    # One row of tiles at a time, so the indices stay small
+        band = img_channel[y0:y0 + tile]
+        histograms[i] = np.bincount((band + column_offsets).ravel(), minlength=nx * LEVELS)
+    return histograms.reshape(ny, nx, LEVELS)
+
+
+def clip_histograms(histograms, clip_limit):
+    """
+    Limits the contrast of the equalisation, as in CLAHE: the bins are clipped at clip_limit times the mean bin count
+    and the clipped pixels are spread evenly over all the bins
+
+    :param histograms: Stack of histograms along the last axis
+    :param clip_limit: Largest bin count in multiples of the mean bin count
+    :return: histograms: Clipped histograms, as floats
+    """
+    limit = np.maximum(clip_limit * histograms.sum(axis=-1, keepdims=True)/histograms.shape[-1], 1)
+    clipped = np.minimum(histograms, limit)
+    excess = (histograms - clipped).sum(axis=-1, keepdims=True)
+    return clipped + excess/histograms.shape[-1]
+
+
+def tiled_equalisation(img_channel, tile, clip_limit=None):
+    """
+    Adaptive histogram equalisation (CLAHE without the clip unless clip_limit is given). The channel is split into
+    tiles, every tile gets the lookup table of its own histogram, and every pixel blends the lookup tables of the four
+    tiles whose centres surround it, weighted by its distance to them. The cost per pixel is a few lookups whatever
+    the tile size
+
+    :param img_channel: Input image channel
+    :param tile: Side of the tiles, i.e. size of the neighbourhood the contrast is adapted to
+    :param clip_limit: Largest bin count in multiples of the mean bin count, None to not limit the contrast
+    :return: equalized_img: Equalised channel
+    """
+    img_channel = img_channel.astype('uint8', copy=False)
+    h, w = img_channel.shape
+    histograms = tile_histograms(img_channel, tile)
+    if clip_limit is not None:
+        histograms = clip_histograms(histograms, clip_limit)
+    luts = cumulative_hist(histograms).astype(np.float32)    # Lookup table of every tile
+    ny, nx = luts.shape[:2]
+    equalized_img = np.empty_like(img_channel)
+
+    # The pixels between the same four tile centres form a block which blends the same four lookup tables. Pixels
+    # before the first or after the last centre only blend the tables of the nearest tiles
+    for i, (y0, y1) in enumerate(_blocks(h, tile, ny)):
+        wy = _weights(y0, y1)[:, None]
+        top, bottom = luts[max(i - 1, 0)], luts[min(i, ny - 1)]
+        for j, (x0, x1) in enumerate(_blocks(w, tile, nx)):
+            wx = _weights(x0, x1)
+            left, right = max(j - 1, 0), min(j, nx - 1)
+            for b0 in range(y0, y1, BAND_ROWS):    # The bands bound the size of the temporaries
+                b1 = min(y1, b0 + BAND_ROWS)
+                block = img_channel[b0:b1, x0:x1]
+                upper = np.take(top[left], block)
+                upper += wx * (np.take(top[right], block) - upper)    # Blend along the rows of the tiles
+                lower = np.take(bottom[left], block)
+                lower += wx * (np.take(bottom[right], block) - lower)
+                upper += wy[b0 - y0:b1 - y0] * (lower - upper)    # Blend the rows of tiles together
+                equalized_img[b0:b1, x0:x1] = upper    # Truncated like equalisation_lut
+    return equalized_img
+
+
+def _blocks(size, tile, n):
+    """
+    :param size: Height or width of the image
+    :param tile: Side of the tiles
+    :param n: Number of tiles along this axis
+    :return: blocks: List of (start, end) pixel ranges between consecutive tile centres, including the ranges before
+     the first and after the last centre
+    """
+    centres = [min(k * tile + tile//2, size) for k in range(n)]
+    bounds = [0] + centres + [size]
+    return [(bounds[k], bounds[k + 1]) for k in range(n + 1)]
+
+
+def _weights(start, end):
+    """
+    :param start: First pixel of a block, at the previous tile centre
+    :param end: End of the block, at the next tile centre
+    :return: weights: Weight of the next tile centre for every pixel of the block, from 0 at the previous centre
+     towards 1 at the next one
+    """
+    return (np.arange(end - start)/float(max(end - start, 1))).astype(np.float32)
+
+
+def local_histogram_eq(img, window, clip_limit=None):
+    """
+    Performs local histogram equalisation, adapting the contrast of every region to its own histogram. Small windows
+    are equalised exactly by ranking every pixel in its window, large windows with interpolated tiles of the size of
+    the window
+
+    :param img: Input image channel
+    :param window: Size of the neighbourhood in pixels
+    :param clip_limit: Largest bin count of the tiles in multiples of the mean bin count, None to not limit the
+     contrast. Only used by the tiled equalisation
+    :return: equalized_img: Equalised image
+    """
+    if window <= 0:
+        raise ValueError("The window must be positive, got %s" % window)
+    window = max(1, int(round(window)))    # Windows scaled down for a preview may fall below 1 pixel
+    if window <= SLIDING_MAX_WINDOW and clip_limit is None:
+        return sliding_equalisation(img, window | 1)    # The window is centred on the pixel, so its side is odd
+    return tiled_equalisation(img, window, clip_limit)
@@ -1,13 +1,17 @@
 import numpy as np
+from image_transforms.lut import apply_lut, gamma_lut
 
 
 def gamma_correct(img, gamma):
     """
-    Performs gamma correction on the input image intensities
+    Performs gamma correction on the input image intensities. 8 bit images are corrected using a lookup table
     :param img: Input image intensities
     :param gamma: Correction factor
     :return: gamma_img: Output gamma corrected image
     """
+    if img.dtype == np.uint8:    # Only 256 intensities are possible, so the transform is computed once per intensity
+        return apply_lut(img, gamma_lut(gamma, img.max()))
+
     gamma_img = np.power(img, 1.0/gamma)                        # gamma corrected image = (original image)^(1/gamma)
     gamma_img = 255.0*gamma_img/np.max(gamma_img)          # Adjusting range of output image
     return gamma_img    # return the gamma corrected image
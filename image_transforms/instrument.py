@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+MAX_EVENTS = 10000    # Number of most recent stage timings kept for the trace
+NESTED_PEAKS = hasattr(tracemalloc, 'reset_peak')    # tracemalloc.reset_peak needs Python 3.9. Before that only
+# the outermost stages record their peak memory, by clearing the traces
+
+_enabled = False
+_memory = False    # Whether the stages also record the memory they allocate
+_memory_owner = None    # Thread whose stages record memory. tracemalloc has one peak for the whole process, so the
+# stages of one thread at a time reset and read it
+_events = deque(maxlen=MAX_EVENTS)    # (name, start, duration, thread id, peak bytes) of the most recent stages
+_totals = {}    # name -> [count, total seconds, max seconds, last seconds, max peak bytes]
+_lock = threading.Lock()
+_local = threading.local()    # Stack of the stages open on the current thread
+_origin = time.perf_counter()    # Trace timestamps are relative to the import of this module
+
+
+class _NullStage(object):
+    """
+    Context manager which does nothing, returned by stage() while instrumentation is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """
+    Context manager which records the wall time, and optionally the peak memory, of a block of code
+    """
+    def __init__(self, name):
+        self.name = name
+        self.peak = None    # Peak bytes allocated inside this stage, updated by the nested stages. None if memory is
+        # not recorded
+        self.before = None    # Bytes traced when the stage started, None if memory is not recorded
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        outer = stack[-1] if stack else None
+        stack.append(self)
+        if _memory and tracemalloc.is_tracing():
+            self._start_memory(outer)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _memory_owner
+        duration = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        if self.before is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak - self.before)
+            outer = stack[-1] if stack else None
+            if outer is not None and outer.before is not None:    # The peak of this stage is also reached inside
+                # the enclosing stage
+                outer.peak = max(outer.peak, self.peak + self.before - outer.before)
+        if not stack and self.before is not None:    # The outermost stage gives the peak to the other threads
+            with _lock:
+                _memory_owner = None
+        _record(self.name, self.start, duration, self.peak)
+        return False
+
+    def _start_memory(self, outer):
+        """
+        Starts recording the peak memory of this stage, if no stage of another thread is recording it. The peak
+        includes what other threads allocate meanwhile
+
+        :param outer: Enclosing stage on this thread, None for an outermost stage
+        """
+        global _memory_owner
+        if outer is None:
+            with _lock:
+                if _memory_owner is not None:    # Resetting the peak would corrupt the stage of the other thread
+                    return
+                _memory_owner = threading.get_ident()
+        elif outer.before is None or not NESTED_PEAKS:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if outer is not None:    # The peak reached so far belongs to the enclosing stage, before it is reset
+            outer.peak = max(outer.peak, peak - outer.before)
+        if NESTED_PEAKS:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()    # Also resets the peak, the blocks allocated before are not traced anymore
+        self.before = tracemalloc.get_traced_memory()[0]
+        self.peak = 0
+
+
+def _record(name, start, duration, peak):
+    """
+    Adds one stage timing to the events and to the totals
+
+    :param name: Name of the stage
+    :param start: perf_counter value at the start of the stage
+    :param duration: Duration in seconds
+    :param peak: Peak bytes allocated during the stage, None if memory is not recorded
+    """
+    _events.append((name, start, duration, threading.get_ident(), peak))
+    with _lock:
+        total = _totals.get(name)
+        if total is None:
+            _totals[name] = [1, duration, duration, duration, peak]
+        else:
+            total[0] += 1
+            total[1] += duration
+            total[2] = max(total[2], duration)
+            total[3] = duration
+            total[4] = peak if total[4] is None else max(total[4], peak or 0)
+
+
+def enable(memory=False):
+    """
+    Starts recording the stages
+
+    :param memory: Whether to also record the peak memory of every stage using tracemalloc, which slows NumPy
+     allocations down. tracemalloc has one peak for the whole process: the stages of one thread at a time record
+     memory, and the stages running concurrently on other threads are only timed. Nested stages record their own
+     peak from Python 3.9, earlier versions only record the peak of the outermost stages
+    """
+    global _enabled, _memory
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable():
+    """
+    Stops recording the stages. The recorded statistics are kept
+    """
+    global _enabled, _memory
+    _enabled = False
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+
+
+def is_enabled():
+    """
+    :return: enabled: Whether the stages are being recorded
+    """
+    return _enabled
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the transform or display path, e.g. "with stage('convolution'):". When
+    instrumentation is disabled a shared no-op context manager is returned, so the cost is one global lookup
+
+    :param name: Name of the stage
+    :return: context: Context manager
+    """
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def stats():
+    """
+    :return: stats: Dict name -> dict with the 'count', 'total', 'mean', 'max' and 'last' durations in seconds and the
+     'peak_bytes' of every stage, None if its memory was never recorded
+    """
+    with _lock:
+        return {name: {'count': count, 'total': total, 'mean': total/count, 'max': longest, 'last': last,
+                       'peak_bytes': peak}
+                for name, (count, total, longest, last, peak) in _totals.items()}
+
+
+def recent(n=10):
+    """
+    :param n: Number of events
+    :return: events: The n most recent (name, duration in seconds) stage timings, oldest first
+    """
+    return [(name, duration) for name, _, duration, _, _ in list(_events)[-n:]]
+
+
+def reset():
+    """
+    Forgets every recorded stage
+    """
+    with _lock:
+        _events.clear()
+        _totals.clear()
+
+
+def export_trace(path):
+    """
+    Writes the recorded stages in the Chrome trace event format, which can be opened in chrome://tracing or Perfetto
+
+    :param path: Path of the JSON trace file
+    """
+    pid = os.getpid()
+    events = [{'name': name, 'ph': 'X', 'ts': 1e6 * (start - _origin), 'dur': 1e6 * duration, 'pid': pid, 'tid': tid,
+               'args': {'peak_bytes': peak}}
+              for name, start, duration, tid, peak in list(_events)]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -1,14 +1,18 @@
 import numpy as np
+from image_transforms.lut import apply_lut, log_lut
 
 
 def log_trans(img):
     """
     Function takes the input image and returns its log transform
-    taken to the base 2
+    taken to the base 2. 8 bit images are transformed using a lookup table
 
     :param img: Image
     :return: log_img: Log transformed image
     """
+    if img.dtype == np.uint8:    # Only 256 intensities are possible, so the transform is computed once per intensity
+        return apply_lut(img, log_lut(img.max()))
+
     c = 255.0/np.log2(1 + np.max(img))   # Constant used for normalising the image so that the pixels lie in [0,255]
     log_img = np.log2(1 + img)  # s(r) = log_2(1+r) for log transformation
     log_img = c*log_img    # Normalising the log transformed image using above constant
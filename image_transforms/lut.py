@@ -0,0 +1,68 @@
+import numpy as np
+import cv2
+
+LEVELS = 256    # Number of intensities that an 8 bit image can take
+CV_LUT_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64)    # Tables cv2.LUT
+# can apply, other tables are applied with NumPy
+
+
+def apply_lut(img, lut):
+    """
+    Applies a point transform to an 8 bit image using a lookup table. Every pixel is replaced by the table entry at its
+    intensity, so the cost is a single gather however expensive the transform is. 8 bit images go through cv2.LUT,
+    which reads the pixels directly, np.take would first convert them to a temporary of 8 byte indices
+
+    :param img: Input 8 bit image
+    :param lut: Lookup table with LEVELS entries
+    :return: transformed_img: Output transformed image, with the dtype of the lookup table
+    """
+    if img.dtype == np.uint8 and lut.dtype in CV_LUT_DTYPES:
+        return cv2.LUT(img, lut).reshape(img.shape)    # Single channel images come back without their channel axis
+    return np.take(lut, img)    # transformed_img[i, j] = lut[img[i, j]]
+
+
+def to_uint8(lut):
+    """
+    Rounds a floating point lookup table to 8 bit intensities
+
+    :param lut: Floating point lookup table
+    :return: lut: 8 bit lookup table
+    """
+    return np.rint(np.clip(lut, 0, LEVELS - 1)).astype(np.uint8)
+
+
+def gamma_lut(gamma, max_value=LEVELS - 1):
+    """
+    Lookup table of the gamma correction, s(r) = 255 * (r/max)^(1/gamma)
+
+    :param gamma: Correction factor
+    :param max_value: Maximum intensity of the image which is being corrected
+    :return: lut: 8 bit lookup table
+    """
+    levels = np.arange(LEVELS, dtype=np.float64)
+    if max_value == 0:    # A completely dark image stays dark
+        return np.zeros(LEVELS, dtype=np.uint8)
+    return to_uint8(255.0 * np.power(levels/max_value, 1.0/gamma))
+
+
+def log_lut(max_value=LEVELS - 1):
+    """
+    Lookup table of the log transform, s(r) = c * log_2(1 + r) with c chosen so that max maps to 255
+
+    :param max_value: Maximum intensity of the image which is being transformed
+    :return: lut: 8 bit lookup table
+    """
+    levels = np.arange(LEVELS, dtype=np.float64)
+    c = 255.0/np.log2(1.0 + max_value)    # Constant used for normalising the image so that the pixels lie in [0,255]
+    return to_uint8(c * np.log2(1 + levels))
+
+
+def compose(first, second):
+    """
+    Composes two lookup tables, so that applying the result is the same as applying 'first' and then 'second'
+
+    :param first: Lookup table applied first
+    :param second: Lookup table applied second
+    :return: lut: Composed lookup table
+    """
+    return np.take(second, first)
@@ -0,0 +1,240 @@
+import numpy as np
+import cv2
+from image_transforms.blur import gaussian_blur
+from image_transforms.cache import default_cache
+from image_transforms.edge_detector import edge_detector
+from image_transforms.equalisation import create_histogram, equalisation_lut, local_histogram_eq
+from image_transforms.instrument import stage
+from image_transforms.lut import LEVELS, apply_lut, compose, gamma_lut, log_lut
+from image_transforms.sharpen import gaussian_unsharp_masking, thresholded_unsharp_masking
+from image_transforms.storage import compact, working
+
+
+def _max_level(histogram):
+    """
+    Highest intensity present in an image, read off its histogram
+
+    :param histogram: Histogram of the image
+    :return: level: Highest intensity with a non zero count
+    """
+    levels = np.flatnonzero(histogram)
+    return levels[-1] if levels.size else 0
+
+
+def _edge(img, threshold):
+    """
+    Sobel edge detection on the grayscale version of a BGR image, returned as a BGR image
+
+    :param img: Input BGR image
+    :param threshold: The threshold to be applied on the gradient values
+    :return: color_image: Edge map as an 8 bit BGR image
+    """
+    gray_image = cv2.cvtColor(working(img), cv2.COLOR_BGR2GRAY)    # Convert BGR image to Grayscale
+    edges = edge_detector(gray_image, threshold).astype('uint8')    # Perform sobel edge detection, the edge map is
+    # exactly 0 or 255
+    return cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)    # Convert the edge map back to BGR
+
+
+def _local_equalise(img, window, clip_limit=None):
+    """
+    Local histogram equalisation of the 'V' channel of a BGR image, see equalisation.local_histogram_eq
+
+    :param img: Input BGR image
+    :param window: Size of the neighbourhood in pixels
+    :param clip_limit: Largest bin count of the tiles in multiples of the mean bin count, None to not limit the contrast
+    :return: color_image: Output 8 bit BGR image
+    """
+    hsv_image = cv2.cvtColor(img.astype(np.float32, copy=False), cv2.COLOR_BGR2HSV)    # Convert it into HSV type
+    v_channel = np.clip(hsv_image[:, :, 2], 0, LEVELS - 1).astype('uint8')    # 8 bit 'V' channel
+    hsv_image[:, :, 2] = local_histogram_eq(v_channel, window, clip_limit)
+    return compact(cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR))    # Convert the image back into BGR format
+
+
+# Point operations on the 'V' channel. Each one builds the lookup table of the operation from the histogram of the
+# channel it is applied on, which is enough as the operations only depend on the maximum or on the histogram
+POINT_OPERATIONS = {
+    'equalise': lambda histogram: equalisation_lut(histogram),
+    'gamma': lambda histogram, gamma: gamma_lut(gamma, _max_level(histogram)),
+    'log': lambda histogram: log_lut(_max_level(histogram)),
+}
+
+# Operations on the whole BGR image, which cannot be folded into a lookup table. Their results are cached and stored
+# in the undo stack, so they are compacted: blurs keep their fractional intensities as float16, the others are 8 bit
+SPATIAL_OPERATIONS = {
+    'blur': lambda img, std: compact(gaussian_blur(img, std), precise=True),
+    'sharpen': lambda img, std, c, threshold=0: compact(thresholded_unsharp_masking(img, std, c, threshold)
+                                                        if threshold > 0 else gaussian_unsharp_masking(img, std, c)),
+    'edge': _edge,
+    'local_equalise': _local_equalise,
+}
+
+
+class Pipeline(object):
+    """
+    Lazy chain of operations on a BGR image. Operations are only recorded, and pixels are computed when the result is
+    materialised. Consecutive point operations on the 'V' channel are fused: the image goes through one HSV round
+    trip and one gather with the composition of their lookup tables
+    """
+    def __init__(self, source, operations=()):
+        """
+        :param source: Input BGR image
+        :param operations: Sequence of (name, params) tuples which are applied in order
+        """
+        self.source = source
+        self.operations = tuple(operations)
+
+    @classmethod
+    def from_recipe(cls, source, recipe):
+        """
+        Creates a pipeline from a recipe, e.g. [{"op": "equalise"}, {"op": "gamma", "gamma": 1.5}]
+
+        :param source: Input BGR image
+        :param recipe: List of dicts, each with the name of the operation under 'op' and its parameters
+        :return: pipeline: Pipeline applying the steps of the recipe in order
+        """
+        pipeline = cls(source)
+        for step in recipe:
+            params = dict(step)
+            pipeline = pipeline.then(params.pop('op'), **params)
+        return pipeline
+
+    def recipe(self):
+        """
+        :return: recipe: The recorded operations as a list of dicts, the inverse of from_recipe
+        """
+        return [dict(params, op=name) for name, params in self.operations]
+
+    def then(self, name, **params):
+        """
+        Records one more operation. The pipeline is not changed, a new pipeline sharing the same source is returned
+
+        :param name: Name of the operation, a key of POINT_OPERATIONS or SPATIAL_OPERATIONS
+        :param params: Parameters of the operation
+        :return: pipeline: Pipeline with the operation appended
+        """
+        if name not in POINT_OPERATIONS and name not in SPATIAL_OPERATIONS:
+            raise ValueError("Unknown operation '%s'" % name)
+        return Pipeline(self.source, self.operations + ((name, params),))
+
+    def equalise(self):
+        """Records histogram equalisation of the 'V' channel"""
+        return self.then('equalise')
+
+    def gamma(self, gamma):
+        """Records gamma correction of the 'V' channel"""
+        return self.then('gamma', gamma=gamma)
+
+    def log(self):
+        """Records log transformation of the 'V' channel"""
+        return self.then('log')
+
+    def local_equalise(self, window, clip_limit=None):
+        """Records local histogram equalisation of the 'V' channel"""
+        if clip_limit is not None:
+            return self.then('local_equalise', window=window, clip_limit=clip_limit)
+        return self.then('local_equalise', window=window)
+
+    def blur(self, std):
+        """Records gaussian blurring"""
+        return self.then('blur', std=std)
+
+    def sharpen(self, std, c, threshold=0):
+        """Records gaussian unsharp masking, only of the details of at least threshold if it is positive"""
+        if threshold > 0:
+            return self.then('sharpen', std=std, c=c, threshold=threshold)
+        return self.then('sharpen', std=std, c=c)
+
+    def edge(self, threshold):
+        """Records sobel edge detection"""
+        return self.then('edge', threshold=threshold)
+
+    def stages(self):
+        """
+        Groups the operations into stages. Consecutive point operations form one stage, every spatial operation is a
+        stage of its own
+
+        :return: stages: List of (is_point, operations) tuples
+        """
+        stages = []
+        for name, params in self.operations:
+            is_point = name in POINT_OPERATIONS
+            if is_point and stages and stages[-1][0]:    # Fuse with the previous stage of point operations
+                stages[-1][1].append((name, params))
+            else:
+                stages.append((is_point, [(name, params)]))
+        return stages
+
+    def materialise(self, cache=default_cache):
+        """
+        Computes the pixels of the result
+
+        :param cache: Cache memoizing the spatial operations, None for images which are never transformed twice such
+         as video frames
+        :return: img: Output BGR image
+        """
+        img = self.source
+        for is_point, operations in self.stages():
+            if is_point:
+                img = _apply_point_stage(img, operations)
+            else:
+                name, params = operations[0]
+                img = apply_spatial_operation(name, img, cache=cache, **params)
+        return img
+
+
+def _apply_point_stage(img, operations):
+    """
+    Applies consecutive point operations on the 'V' channel of a BGR image in one pass. The lookup tables of the
+    operations are composed, and the histogram seen by every operation is derived from the histogram of the input
+    instead of from intermediate images
+
+    :param img: Input BGR image
+    :param operations: List of (name, params) tuples of point operations
+    :return: color_image: Output BGR image
+    """
+    with stage('hsv.from_bgr'):
+        hsv_image = cv2.cvtColor(img.astype(np.float32, copy=False), cv2.COLOR_BGR2HSV)    # Convert it into HSV
+        # type. The conversion is done in float32 as 8 bit HSV would quantise the hue to steps of 2 degrees
+
+    with stage('point.' + '+'.join(name for name, _ in operations)):
+        v_channel = np.clip(hsv_image[:, :, 2], 0, LEVELS - 1).astype('uint8', copy=False)    # 8 bit 'V' channel
+        histogram = create_histogram(v_channel)    # Histogram of the 'V' channel before the first operation
+
+        lut = np.arange(LEVELS, dtype=np.uint8)    # Identity lookup table
+        for name, params in operations:
+            operation_lut = POINT_OPERATIONS[name](histogram, **params)
+            histogram = np.bincount(operation_lut, weights=histogram, minlength=LEVELS).astype(np.int64)  # Histogram
+            # of the channel after this operation, every count moves to the intensity its level is mapped to
+            lut = compose(lut, operation_lut)
+
+        hsv_image[:, :, 2] = apply_lut(v_channel, lut)    # Change the 'V' channel to the transformed one
+
+    with stage('hsv.to_bgr'):
+        return cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)    # Convert the image back into BGR format
+
+
+def apply_spatial_operation(name, img, cache=default_cache, **params):
+    """
+    Applies a spatial operation through the shared transform cache, so repeating an operation with the same
+    parameters on the same pixels returns the earlier result
+
+    :param name: Name of the operation, a key of SPATIAL_OPERATIONS
+    :param img: Input BGR image
+    :param cache: Cache memoizing the result, None to compute it without hashing the image
+    :param params: Parameters of the operation
+    :return: img: Output BGR image
+    """
+    with stage('spatial.' + name):
+        if cache is None:
+            return SPATIAL_OPERATIONS[name](img, **params)
+        return cache.call(name, SPATIAL_OPERATIONS[name], img, **params)
+
+
+def materialise(image):
+    """
+    Returns the pixels of an image which may be a lazy pipeline
+
+    :param image: BGR image or Pipeline
+    :return: img: BGR image
+    """
+    return image.materialise() if isinstance(image, Pipeline) else image
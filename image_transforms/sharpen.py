@@ -1,17 +1,107 @@
-from image_transforms.blur import gaussian_blur
+from functools import lru_cache
+import numpy as np
+from image_transforms.blur import BOX_BLUR_MIN_STD, gaussian_blur, gaussian_kernel
+from image_transforms.convolution import batch_convolution, separate_kernel
 
+UNSHARP_KERNEL_CACHE = 32    # Number of (std, c) unsharp masking kernels kept
 
-def gaussian_unsharp_masking(img, std, c):
+
+@lru_cache(maxsize=UNSHARP_KERNEL_CACHE)
+def unsharp_kernel(std, c):
+    """
+    Unsharp masking is linear, img - c*blur(img) is the convolution of the image with the identity kernel minus c
+    times the gaussian kernel. The kernel is built once per (std, c). It is the sum of two separable kernels, the
+    identity whose 1D kernels have a single tap and the scaled gaussian, so it is still applied as 1D passes
+
+    :param std: Standard Deviation of the Gaussian Kernel
+    :param c: Constant which needs to be multiplied with the blurred image while subtracting
+    :return: (kernel, factors): Read only unsharp masking kernel and its separable terms, see
+     convolution.low_rank_factors
+    """
+    gaussian = gaussian_kernel(std)
+    column, row = separate_kernel(gaussian)
+    radius = gaussian.shape[0]//2
+    identity = np.zeros(gaussian.shape[0])
+    identity[radius] = 1.0
+
+    kernel = -c * gaussian
+    kernel[radius, radius] += 1.0    # Adding the identity kernel
+    kernel.setflags(write=False)    # Shared by all the callers
+    return kernel, [[(identity, identity), (-c * column, row)]]
+
+
+def fused_unsharp_masking(img, std, c, out=None, clip=True):
+    """
+    Unsharp masking in one batched convolution with the fused kernel, followed by clipping in place. No blurred image
+    is created
+
+    :param img: Input image, of any dtype
+    :param std: Standard Deviation of the Gaussian Kernel, must be positive
+    :param c: Constant which needs to be multiplied with the blurred image while subtracting
+    :param out: Optional preallocated float32 output of the shape of the image. May be the input image itself
+    :param clip: Whether to clip the output to [0, 255]
+    :return: sharpened_img: Output sharpened image
     """
-    Performs Unsharp Masking using the input image and a gaussian blurring kernel
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    kernel, factors = unsharp_kernel(float(std), float(c))
+    batch_convolution(img, kernel, out=out[..., None], factors=factors)    # The image is padded before the output is
+    # written, so the output may be the input
+    if clip:
+        np.clip(out, 0, 255, out=out)    # Clipping the values to between 0, 255
+    return out
 
-    :param img: Input image
+
+def gaussian_unsharp_masking(img, std, c, out=None):
+    """
+    Performs Unsharp Masking using the input image and a gaussian blurring kernel. Stds which gaussian_blur applies as
+    a convolution use the fused kernel. For larger stds the image is blurred into the output buffer with box filters
+    and sharpened there in place. Either way the output is the only full size float allocation
+
+    :param img: Input image, of any dtype
     :param std: Standard Deviation of the Gaussian Kernel
     :param c: Constant which needs to be multiplied with the blurred image while subtracting
+    :param out: Optional preallocated float32 output of the shape of the image. May only be the input image itself
+     if 0 < std < BOX_BLUR_MIN_STD
     :return: sharpened_img: Output sharpened image
     """
-    blurred_image = gaussian_blur(img, std)    # Performing gaussian blurring
-    sharpened_img = img - c*blurred_image    # Performing unsharp masking. Using a constant while subtracting
-    # which is fed by the user
-    sharpened_img = sharpened_img.clip(0, 255)    # Clipping the values to between 0, 255
+    if 0 < std < BOX_BLUR_MIN_STD:
+        return fused_unsharp_masking(img, std, c, out)
+
+    if out is not None and np.may_share_memory(out, img):
+        raise ValueError("The output of unsharp masking cannot overlap its input")
+    sharpened_img = gaussian_blur(img, std, out=out)    # Performing gaussian blurring
+    sharpened_img *= -c    # Performing unsharp masking. Using a constant while subtracting which is fed by the user
+    sharpened_img += img
+    np.clip(sharpened_img, 0, 255, out=sharpened_img)    # Clipping the values to between 0, 255
     return sharpened_img    # Returning the sharpened image
+
+
+def thresholded_unsharp_masking(img, std, c, threshold, out=None):
+    """
+    Unsharp masking which only sharpens the pixels whose detail, the difference between the image and its blurred
+    version, is at least the threshold. Flat areas and low amplitude noise are left unchanged
+
+    :param img: Input image, of any dtype
+    :param std: Standard Deviation of the Gaussian Kernel
+    :param c: Constant which needs to be multiplied with the blurred image while subtracting
+    :param threshold: Smallest absolute detail which is sharpened
+    :param out: Optional preallocated float32 output of the shape of the image. Must not overlap the input image
+    :return: sharpened_img: Output sharpened image
+    """
+    if out is not None and np.may_share_memory(out, img):
+        raise ValueError("The output of unsharp masking cannot overlap its input")
+    if 0 < std < BOX_BLUR_MIN_STD:
+        sharpened_img = fused_unsharp_masking(img, std, c, out, clip=False)
+    else:
+        sharpened_img = gaussian_blur(img, std, out=out)
+        sharpened_img *= -c
+        sharpened_img += img
+
+    detail = np.multiply(img, c - 1, dtype=np.float32)    # sharpened - (1 - c)*img = c*(img - blurred), so the
+    # detail is recovered from the sharpened image without blurring again
+    detail += sharpened_img
+    np.abs(detail, out=detail)
+    np.copyto(sharpened_img, img, where=detail < threshold * abs(c))    # Pixels below the detail level keep their value
+    np.clip(sharpened_img, 0, 255, out=sharpened_img)
+    return sharpened_img
@@ -0,0 +1,35 @@
+import numpy as np
+
+STORAGE_DTYPES = (np.uint8, np.float16)    # Representations of the images kept in the undo stack and the caches
+
+
+def compact(img, precise=False):
+    """
+    Converts an image to the representation kept in the undo stack and the caches: 8 bit intensities, a quarter of
+    the memory of float32. Results whose fractional intensities matter to the operations applied after them, such as
+    blurs which are then sharpened or thresholded, can be kept as float16 instead, half the memory of float32
+
+    :param img: Image with intensities in [0, 255]
+    :param precise: Whether to keep the fractional intensities as float16
+    :return: img: uint8 image, or float16 image if precise. The input itself if it already has that dtype
+    """
+    if img.dtype == np.uint8 or (precise and img.dtype == np.float16):
+        return img
+    if precise:
+        compacted = img.astype(np.float16)
+        return np.clip(compacted, 0, 255, out=compacted)
+    if img.dtype.kind in 'iu':
+        return np.clip(img, 0, 255).astype(np.uint8)
+    rounded = np.clip(img, 0, 255)    # One float temporary, rounded in place
+    return np.rint(rounded, out=rounded).astype(np.uint8)
+
+
+def working(img):
+    """
+    Converts an image to a dtype OpenCV accepts. float16 images are widened to float32, other images are returned
+    as they are
+
+    :param img: Image from the undo stack or the caches
+    :return: img: uint8 or float image
+    """
+    return img.astype(np.float32) if img.dtype == np.float16 else img
@@ -0,0 +1,272 @@
+import os
+import numpy as np
+import cv2
+from PIL import Image
+from image_transforms.blur import blur_radius, gaussian_blur
+from image_transforms.edge_detector import sobel_gradients
+from image_transforms.pipeline import SPATIAL_OPERATIONS
+from image_transforms.sharpen import gaussian_unsharp_masking
+from image_transforms.storage import working
+
+DEFAULT_TILE = 1024    # Side of the square tiles, in pixels
+SOBEL_RADIUS = 1    # The Sobel kernels are 3x3
+TILED_OPERATIONS = ('blur', 'sharpen', 'edge')    # Recipe steps which can be run tile by tile. The other operations
+# equalise or rescale with statistics of the whole image
+RAW_MODES = {'RGB': (3, [2, 1, 0]), 'BGR': (3, [0, 1, 2]), 'L': (1, [0, 0, 0])}    # Pixel layouts of the files
+# which are streamed: number of channels and the channels giving B, G and R
+
+
+def open_image(path):
+    """
+    Opens an image stored as a .npy file as a read only memory mapped array, so its pixels are only read from disk
+    when a tile needs them
+
+    :param path: Path of the .npy file
+    :return: img: Memory mapped image
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def image_pixels(path):
+    """
+    :param path: Path of an image file
+    :return: pixels: Number of pixels of the image, read from its header without decoding it. None if Pillow cannot
+     read the header
+    """
+    try:
+        with _open_lazily(path) as img:
+            return img.size[0] * img.size[1]
+    except (OSError, ValueError):
+        return None
+
+
+def convert_image(path, npy_path, rows=DEFAULT_TILE):
+    """
+    Converts an image file into a memory mapped 8 bit BGR .npy file, the input of the tiled transforms. Files which
+    store their pixels uncompressed, such as uncompressed TIFF, BMP or PPM, are streamed from a memory map of the
+    file, a band of rows at a time, so the image is never held whole in RAM. Compressed files such as PNG or JPEG
+    cannot be decoded in parts and are decoded whole with OpenCV
+
+    :param path: Path of the image file
+    :param npy_path: Path of the .npy file which is created
+    :param rows: Rows copied at once when streaming
+    :return: img: Read only memory mapped BGR image
+    """
+    try:
+        with _open_lazily(path) as img:
+            width, height = img.size
+            layout = [_raw_strip(path, tile) for tile in img.tile]
+    except (OSError, ValueError):
+        layout = [None]
+
+    if None in layout:    # Not stored as raw pixels
+        decoded = cv2.imread(path)
+        if decoded is None:
+            raise ValueError("Could not decode image '%s'" % path)
+        np.save(npy_path, decoded)
+        return open_image(npy_path)
+
+    dst = create_image(npy_path, (height, width, 3), np.uint8)
+    for (x0, y0, x1, y1), pixels, channels in layout:
+        for r0 in range(0, y1 - y0, rows):
+            r1 = min(y1 - y0, r0 + rows)
+            dst[y0 + r0:y0 + r1, x0:x1] = pixels[r0:r1, :x1 - x0, channels]
+    dst.flush()
+    del dst
+    return open_image(npy_path)
+
+
+def _open_lazily(path):
+    """
+    Opens an image with Pillow, which only reads the header until the pixels are requested. The decompression bomb
+    check is disabled, large images are what the tiled transforms are for
+
+    :param path: Path of the image file
+    :return: img: Lazily loaded Pillow image
+    """
+    limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+    try:
+        return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def _raw_strip(path, tile):
+    """
+    Memory maps one strip of an image file which stores its pixels uncompressed
+
+    :param path: Path of the image file
+    :param tile: Entry of the tile list of a Pillow image, (decoder, extents, offset, args)
+    :return: strip: (extents, pixels, channels) with the (x0, y0, x1, y1) extents of the strip, a rows x stride x
+     channels memory map of its pixels and the channels giving B, G and R. None if the strip is not raw pixels
+    """
+    decoder, extents, offset, args = tile[:4]
+    rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+    if decoder != 'raw' or rawmode not in RAW_MODES:
+        return None
+    channels, order = RAW_MODES[rawmode]
+    x0, y0, x1, y1 = extents
+    row_bytes = stride or (x1 - x0) * channels    # A stride of 0 means the rows are packed
+    if row_bytes % channels:
+        return None
+    pixels = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(y1 - y0, row_bytes//channels, channels))
+    if orientation < 0:    # Stored bottom up, e.g. BMP
+        pixels = pixels[::-1]
+    return extents, pixels, order
+
+
+def create_image(path, shape, dtype=np.float32):
+    """
+    Creates a memory mapped .npy file which receives the output tile by tile
+
+    :param path: Path of the .npy file
+    :param shape: Shape of the image
+    :param dtype: Data type of the pixels
+    :return: img: Writable memory mapped image
+    """
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def tiles(shape, tile=DEFAULT_TILE):
+    """
+    Splits an image into tiles
+
+    :param shape: Shape of the image
+    :param tile: Side of the tiles
+    :return: Generator of (y0, y1, x0, x1) bounds of the tiles
+    """
+    h, w = shape[:2]
+    for y0 in range(0, h, tile):
+        for x0 in range(0, w, tile):
+            yield y0, min(y0 + tile, h), x0, min(x0 + tile, w)
+
+
+def read_tile(img, bounds, halo):
+    """
+    Reads a tile together with a halo of neighbouring pixels. Where the halo goes past the border of the image it is
+    filled by reflection, the same way the whole image would be padded, so the tiles give the same result as the
+    whole image
+
+    :param img: Input image, usually memory mapped
+    :param bounds: (y0, y1, x0, x1) bounds of the tile
+    :param halo: Number of pixels added on each side
+    :return: tile: Tile of shape (y1 - y0 + 2*halo, x1 - x0 + 2*halo, ...)
+    """
+    y0, y1, x0, x1 = bounds
+    h, w = img.shape[:2]
+    top, bottom = max(0, y0 - halo), min(h, y1 + halo)    # The part of the halo lying inside the image
+    left, right = max(0, x0 - halo), min(w, x1 + halo)
+    tile = np.asarray(img[top:bottom, left:right])
+    pad_width = [(halo - (y0 - top), halo - (bottom - y1)), (halo - (x0 - left), halo - (right - x1))]
+    pad_width += [(0, 0)] * (img.ndim - 2)
+    if any(before or after for before, after in pad_width):
+        tile = np.pad(tile, pad_width, mode='reflect')
+    return tile
+
+
+def tiled_apply(src, dst, function, halo, tile=DEFAULT_TILE):
+    """
+    Applies a transform tile by tile. Every tile is read with a halo as wide as the radius of the transform, the
+    transform is applied on it and the centre of the result is written to the output. The peak memory depends on
+    the tile size and not on the image size
+
+    :param src: Input image, usually memory mapped
+    :param dst: Output image of the same height and width, usually memory mapped
+    :param function: Transform of an image
+    :param halo: Radius of the transform, i.e. how far the pixels it reads are from the pixel it computes
+    :param tile: Side of the tiles
+    :return: dst: The output image
+    """
+    for bounds in tiles(src.shape, tile):
+        y0, y1, x0, x1 = bounds
+        result = function(read_tile(src, bounds, halo))
+        dst[y0:y1, x0:x1] = result[halo:halo + y1 - y0, halo:halo + x1 - x0]
+    return dst
+
+
+def tiled_gaussian_blur(src, dst, std, tile=DEFAULT_TILE):
+    """
+    Gaussian blurring of an image larger than RAM, see blur.gaussian_blur
+
+    :param src: Input image, usually memory mapped
+    :param dst: Output image, usually memory mapped
+    :param std: Standard Deviation of kernel
+    :param tile: Side of the tiles
+    :return: dst: The output image
+    """
+    return tiled_apply(src, dst, lambda img: gaussian_blur(img, std), blur_radius(std), tile)
+
+
+def tiled_unsharp_masking(src, dst, std, c, tile=DEFAULT_TILE):
+    """
+    Unsharp masking of an image larger than RAM, see sharpen.gaussian_unsharp_masking
+
+    :param src: Input image, usually memory mapped
+    :param dst: Output image, usually memory mapped
+    :param std: Standard Deviation of the Gaussian Kernel
+    :param c: Constant which needs to be multiplied with the blurred image while subtracting
+    :param tile: Side of the tiles
+    :return: dst: The output image
+    """
+    return tiled_apply(src, dst, lambda img: gaussian_unsharp_masking(img, std, c), blur_radius(std), tile)
+
+
+def tiled_edge_detector(src, dst, threshold=100, tile=DEFAULT_TILE):
+    """
+    Sobel edge detection of a grayscale image larger than RAM, see edge_detector.edge_detector. The gradient is
+    normalised by its maximum over the whole image, so the tiles are streamed twice: once to write the gradient
+    magnitude and find its maximum, and once to normalise and threshold it in place
+
+    :param src: Input grayscale image, usually memory mapped
+    :param dst: Output image, usually memory mapped. Must have a floating point dtype
+    :param threshold: The threshold to be applied on the gradient values
+    :param tile: Side of the tiles
+    :return: dst: The output edge map
+    """
+    def magnitude(img):
+        gradient_x, gradient_y = sobel_gradients(img)
+        return np.sqrt(np.square(gradient_x) + np.square(gradient_y))    # Pixelwise magnitude of the gradient
+
+    tiled_apply(src, dst, magnitude, SOBEL_RADIUS, tile)
+    max_magnitude = max(float(dst[y0:y1, x0:x1].max()) for y0, y1, x0, x1 in tiles(dst.shape, tile))
+    scale = 255.0/max_magnitude if max_magnitude > 0 else 0.0    # normalising the gradient to [0,255]
+
+    for y0, y1, x0, x1 in tiles(dst.shape, tile):
+        block = dst[y0:y1, x0:x1]
+        block[...] = np.where(block * scale >= threshold, 255.0, 0.0)    # Hard thresholding the gradient
+    return dst
+
+
+def tiled_recipe(src, recipe, work_dir, tile=DEFAULT_TILE):
+    """
+    Applies a recipe on an image larger than RAM, one step at a time. Every step is computed tile by tile into a
+    memory mapped file in work_dir, with the same results as Pipeline.materialise
+
+    :param src: Input BGR image, usually memory mapped
+    :param recipe: List of steps, only the operations of TILED_OPERATIONS
+    :param work_dir: Directory receiving the intermediate images, on a disk with room for a few copies of the image
+    :param tile: Side of the tiles
+    :return: img: Memory mapped result of the last step
+    """
+    for index, step in enumerate(recipe):
+        params = dict(step)
+        name = params.pop('op')
+        if name not in TILED_OPERATIONS:
+            raise ValueError("'%s' cannot be applied tile by tile, only %s can" % (name, ', '.join(TILED_OPERATIONS)))
+        path = os.path.join(work_dir, 'step_%d' % index)
+        if name == 'edge':    # As pipeline._edge: on the grayscale image, and the edge map is returned as BGR
+            gray = create_image(path + '_gray.npy', src.shape[:2])
+            tiled_apply(src, gray, lambda img: cv2.cvtColor(working(img), cv2.COLOR_BGR2GRAY), 0, tile)
+            edges = tiled_edge_detector(gray, create_image(path + '_edges.npy', src.shape[:2]), params['threshold'],
+                                        tile)
+            dst = create_image(path + '.npy', src.shape[:2] + (3,), np.uint8)
+            for y0, y1, x0, x1 in tiles(edges.shape, tile):
+                dst[y0:y1, x0:x1] = edges[y0:y1, x0:x1, None]    # The edge map is exactly 0 or 255
+        else:
+            operation = SPATIAL_OPERATIONS[name]
+            dtype = np.float16 if name == 'blur' else np.uint8    # The dtypes the pipeline compacts the results to
+            dst = create_image(path + '.npy', src.shape, dtype)
+            tiled_apply(src, dst, lambda img: operation(img, **params), blur_radius(params['std']), tile)
+        dst.flush()
+        src = dst
+    return src
@@ -1,24 +1,42 @@
+import os
 import tkinter as tk
 from tkinter import ttk
+from image_transforms import instrument
 from utils.display_image import DisplayImage
 from utils.buttons import ToolBar
+from utils.history import History
+from utils.executor import TransformExecutor
+from utils.lazy import warm_up
+from utils.preview import Preview
 
 
 class Main(tk.Tk):
     """
     The main class that is run in the code. It sets up the toolbar and the canvas for GUI.
     """
-    def __init__(self):
+    def __init__(self, history_budget=None, profile=False, trace_path=None):
         """
         Initialise the class variables, the toolbar and the image canvas for display
+
+        :param history_budget: Bytes of images the undo stack keeps in RAM before spilling to disk. Default if None
+        :param profile: False, True to time the stages of the transforms and of the display in a status bar, or
+         'memory' to also record their peak memory. Nested stages need Python 3.9 for their own peak, and stages
+         overlapping a measured stage of another thread are only timed, see instrument.enable
+        :param trace_path: If set, the recorded stages are written to this trace file when the window is closed
         """
         tk.Tk.__init__(self)    # Initialise the Tk class
 
-        self.images = []    # The stack of images that have been displayed. Used for undo button
+        self.images = History() if history_budget is None else History(history_budget)    # The stack of images that
+        # have been displayed. Used for undo button
         self.horizontal = None    # The horizontal slider
         self.vertical = None    # The vertical slider
         self.filename = ""    # The filename that the user enters to load/save the file
         self.title("Image Editor")    # Title of the GUI window
+        self.status = None    # Status bar with the timings of the last stages, only created when profiling
+        self.trace_path = trace_path
+        self.executor = TransformExecutor(master=self, on_busy=self.show_progress)    # Runs the transforms in the
+        # background so that the window never freezes
+        self.preview = Preview(master=self)    # Renders the slider values on a downscaled copy of the image
         self.toolbar = ToolBar(master=self)    # Toolbar of the GUI that has the widgets
         self.display_image = DisplayImage(master=self)    # The canvas configuration to display image
 
@@ -28,7 +46,50 @@ class Main(tk.Tk):
         separator.pack(fill=tk.X, padx=20, pady=5)    # Configuring the separator between widgets and canvas
         self.display_image.pack(fill=tk.BOTH, padx=20, pady=10, expand=1)    # Packing the canvas onto the GUI screen
 
+        self.progress = ttk.Progressbar(master=self, mode='indeterminate')    # Shown while a transform is running
+        self.bind("<Escape>", lambda event: self.toolbar.cancel_pending())    # Escape cancels the running transforms
+        self.after_idle(warm_up)    # NumPy, OpenCV and Pillow are imported in the background once the window is shown
+        self.protocol("WM_DELETE_WINDOW", self.close)    # Stops the worker threads, which would keep the process alive
+
+        if profile:
+            instrument.enable(memory=(profile == 'memory'))    # Start timing the stages
+            self.status = ttk.Label(master=self, anchor=tk.W)
+            self.status.pack(side=tk.BOTTOM, fill=tk.X, padx=20, pady=5)
+
+    def show_stats(self):
+        """
+        Shows the durations of the most recent stages in the status bar, if profiling is enabled
+        """
+        if self.status is not None:
+            self.status.config(text="  |  ".join("%s %.1f ms" % (name, 1000 * duration)
+                                                 for name, duration in instrument.recent(8)))
+
+    def close(self):
+        """
+        Cancels the running transforms, stops the worker threads, writes the trace file if one was requested and
+        closes the window
+        """
+        self.executor.shutdown()
+        if self.trace_path:
+            instrument.export_trace(self.trace_path)
+        self.destroy()
+
+    def show_progress(self, busy):
+        """
+        Shows the progress bar while transforms are running in the background and hides it afterwards
+
+        :param busy: Whether a transform is running
+        """
+        if busy:
+            self.progress.pack(fill=tk.X, padx=20, pady=5)
+            self.progress.start()
+        else:
+            self.progress.stop()
+            self.progress.pack_forget()
+
 
 if __name__ == '__main__':    # If this file is run on the terminal
-    root = Main()    # Create an object of main class
+    profile = os.environ.get('EE610_PROFILE', '')    # '1' to show the stage timings, 'memory' to also record memory
+    root = Main(profile='memory' if profile == 'memory' else bool(profile),
+                trace_path=os.environ.get('EE610_TRACE'))    # Create an object of main class
     root.mainloop()    # Run the main class infinitely till the user closes the GUI screen window.
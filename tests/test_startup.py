@@ -0,0 +1,19 @@
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))    # Run from anywhere in the repo
+
+from benchmarks.bench_startup import BUDGET, measure
+
+REPEATS = 3    # Fresh interpreters started, the median is compared to the budget
+
+
+def test_startup_budget():
+    """
+    The GUI must be importable within the startup budget, without loading any of the heavy modules
+    """
+    times, loaded = measure(REPEATS)
+    assert statistics.median(times) <= BUDGET, "import main takes %.0f ms, budget %.0f ms" % (
+        1000 * statistics.median(times), 1000 * BUDGET)
+    assert not loaded, "heavy modules imported at startup: %s" % ', '.join(loaded)
@@ -1,6 +1,12 @@
+import os
 from tkinter import Frame, Button, LEFT, filedialog, Scale, HORIZONTAL, VERTICAL, messagebox
-import cv2
-from image_transforms import log_transform, blur, gamma, edge_detector, equalisation, sharpen
+from utils.history import History
+from utils.lazy import lazy_import
+
+cv2 = lazy_import('cv2')    # Loaded on first use, so that the window appears without waiting for OpenCV
+pipeline = lazy_import('image_transforms.pipeline')
+storage = lazy_import('image_transforms.storage')
+session = lazy_import('utils.session')
 
 
 class ToolBar(Frame):
@@ -17,6 +23,7 @@ class ToolBar(Frame):
 
         self.load_button = Button(self, text="Load Image")   # Button to load image
         self.equalize_button = Button(self, text="Hist Equalization")   # Button to equalize histogram
+        self.local_equalize_button = Button(self, text="Local Equalization")   # Button to equalize local histograms
         self.gamma_correct_button = Button(self, text="Gamma Correct")   # button to perform gaama correction
         self.log_transform_button = Button(self, text="Log Transform")   # Button to perform log transform
         self.blur_button = Button(self, text="Blur")    # Button to perform gaussian blurring
@@ -25,10 +32,13 @@ class ToolBar(Frame):
         self.undo_all_button = Button(self, text="Undo All Changes")    # Button to undo all changes
         self.save_current_button = Button(self, text="Save Current")   # Button to save the current displayed image
         self.edge_detector_button = Button(self, text="Edge Detector")  # Button to perform sobel edge detection
+        self.save_session_button = Button(self, text="Save Session")    # Button to save the steps and the current image
+        self.open_session_button = Button(self, text="Open Session")    # Button to reopen a saved session
 
         # Binding all the buttons to the action that will be performed when the user presses them
         self.load_button.bind("<ButtonRelease>", self.load_button_released)
         self.equalize_button.bind("<ButtonRelease>", self.equalize_button_released)
+        self.local_equalize_button.bind("<ButtonRelease>", self.local_equalize_released)
         self.gamma_correct_button.bind("<ButtonRelease>", self.gamma_correct_released)
         self.log_transform_button.bind("<ButtonRelease>", self.log_transform_released)
         self.blur_button.bind("<ButtonRelease>", self.blur_released)
@@ -37,10 +47,13 @@ class ToolBar(Frame):
         self.undo_all_button.bind("<ButtonRelease>", self.undo_all_released)
         self.save_current_button.bind("<ButtonRelease>", self.save_current_released)
         self.edge_detector_button.bind("<ButtonRelease>", self.edge_detector_released)
+        self.save_session_button.bind("<ButtonRelease>", self.save_session_released)
+        self.open_session_button.bind("<ButtonRelease>", self.open_session_released)
 
         # Packing all buttons to the GUI window where they will be seen by the user. They will be arranged horizontally
         self.load_button.pack(side=LEFT)
         self.equalize_button.pack(side=LEFT)
+        self.local_equalize_button.pack(side=LEFT)
         self.gamma_correct_button.pack(side=LEFT)
         self.log_transform_button.pack(side=LEFT)
         self.blur_button.pack(side=LEFT)
@@ -48,6 +61,8 @@ class ToolBar(Frame):
         self.undo_last_button.pack(side=LEFT)
         self.undo_all_button.pack(side=LEFT)
         self.save_current_button.pack(side=LEFT)
+        self.save_session_button.pack(side=LEFT)
+        self.open_session_button.pack(side=LEFT)
         self.edge_detector_button.pack()
 
     def image_present_check(self):
@@ -60,6 +75,94 @@ class ToolBar(Frame):
         else:
             return True   # If there are images present in the list, then return True value
 
+    def cancel_pending(self):
+        """
+        Cancels the pending previews and the transforms which are still running
+        """
+        self.master.preview.cancel()
+        self.master.executor.cancel()
+
+    def current_image(self):
+        """
+        Returns the pixels of the displayed image, computing them if the image is a lazy pipeline of point operations
+
+        :return: img: The displayed image
+        """
+        return pipeline.materialise(self.master.images[-1])
+
+    def apply_point_operation(self, name, **params):
+        """
+        Applies a point operation on the 'V' channel of the displayed image. The operation is recorded on a lazy
+        pipeline, so that consecutive point operations are computed in one HSV round trip and no intermediate images
+        are stored in the stack
+
+        :param name: Name of the point operation, one of pipeline.POINT_OPERATIONS
+        :param params: Parameters of the operation
+        """
+        self.master.preview.cancel(restore=False)    # The edit is committed, so the preview is not needed anymore
+        images, index = self.master.images, len(self.master.images) - 1    # The displayed image, read on the worker
+        # as an entry of a reopened session may have to be recomputed first
+
+        def job():
+            img = images[index]
+            if not isinstance(img, pipeline.Pipeline):    # Start a new pipeline from the pixels of the displayed image
+                img = pipeline.Pipeline(img)
+            transformed = img.then(name, **params)    # Record the operation after the ones already pending
+            return transformed, transformed.materialise()
+
+        self.master.executor.submit('transform', job,
+                                    on_done=lambda result: self.push_image(result[1], entry=result[0],
+                                                                           step=result[0].recipe()[-1]))  # Compute
+        # the pixels in the background, only the pipeline is stored in the stack
+
+    def apply_spatial_operation(self, name, **params):
+        """
+        Applies a spatial operation on the displayed image in the background. A newer operation supersedes this one
+        if it has not finished yet
+
+        :param name: Name of the operation, one of pipeline.SPATIAL_OPERATIONS
+        :param params: Parameters of the operation
+        """
+        self.master.preview.cancel(restore=False)    # The edit is committed, so the preview is not needed anymore
+        images, index = self.master.images, len(self.master.images) - 1    # The displayed image, read on the worker
+        job = lambda: pipeline.apply_spatial_operation(name, pipeline.materialise(images[index]), **params)
+        self.master.executor.submit('transform', job,
+                                    on_done=lambda img: self.push_image(img, step=dict(params, op=name)))  # Results
+        # are memoized, so re-applying an operation after an undo is instant
+
+    def display_last(self):
+        """
+        Displays the last image of the stack. An entry of a reopened session which was not produced yet is decoded or
+        recomputed on the executor like a transform, with the progress bar shown and Escape to cancel, as replaying
+        its steps on a large image would otherwise freeze the window
+        """
+        images = self.master.images
+        if images.is_loaded(-1):
+            self.master.display_image.display_image(img=images[-1])
+            return
+        self.master.display_image.clear_canvas()    # The undone image must not stay on the screen meanwhile
+        index = len(images) - 1
+
+        def job():
+            entry = images[index]
+            return entry, pipeline.materialise(entry)
+
+        self.master.executor.submit('transform', job,
+                                    on_done=lambda result: self.master.display_image.display_image(img=result[1],
+                                                                                                   key=result[0]))
+
+    def push_image(self, img, entry=None, step=None):
+        """
+        Displays a transformed image and appends it to the stack. Called on the Tk thread when a transform finishes
+
+        :param img: Pixels of the transformed image
+        :param entry: What is stored in the stack for this image, the pixels themselves if None
+        :param step: The operation which produced the image, e.g. {"op": "blur", "std": 2}, saved in sessions
+        """
+        entry = img if entry is None else entry    # What is stored in the stack for this image
+        self.master.display_image.display_image(img=img, key=entry)    # Display this transformed image
+        self.master.images.append(entry, step)    # Append this image to the stack
+
     def load_button_released(self, event):
         """
         Describes behaviour of load button when the user clicks on it. It loads the image onto the screen from the
@@ -69,13 +172,16 @@ class ToolBar(Frame):
         """
         if self.winfo_containing(event.x_root, event.y_root) == self.load_button:  # If the clicked area contains the
             # load button
+            self.cancel_pending()    # Transforms of the previous image are not needed anymore
             filename = filedialog.askopenfilename()    # A file dialog opens asking the user to select the file
-            img = cv2.imread(filename)    # Image is read from that file location
-            img = img.astype('float32')    # Convert the pixels to 8 bit float to perform float operations on them
+            img = cv2.imread(filename)    # Image is read from that file location, the pixels are kept as 8 bit ints
+            # which is also how the transforms store their results in the stack
 
             if img is not None:    # If image is selected
                 self.master.filename = filename    # Set the filename parameter
-                self.master.images.append(img)     # Append the selected image in the stack
+                self.master.images.append(img, {'op': 'load', 'path': os.path.abspath(filename)})     # Append the
+                # selected image in the stack, sessions reload it from its path
+                self.master.display_image.reset_view()    # Fit the new image on the screen
                 self.master.display_image.display_image(img=img)    # Display the image on the window
 
     def save_current_released(self, event):
@@ -88,13 +194,61 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.save_current_button: # If clicked area contains
             # save button
             if self.image_present_check():    # If image is present in the stack
+                self.master.preview.cancel()    # An uncommitted preview is not saved, so it is not shown either
                 file_type = self.master.filename.split('.')[-1]    # Get the file extension from the filename
                 filename = filedialog.asksaveasfile()    # Invoke a dialog box asking the user what name they want to
                 # save the image as and get the abolute path
                 filename = filename.name + '.' + file_type    # Append the file extension to the path
-                cv2.imwrite(filename, self.master.images[-1])    # Save the image in the path provided by user
+                cv2.imwrite(filename, storage.compact(self.current_image()))    # Save the image in the path provided
+                # by user, as 8 bit intensities
                 self.master.filename = filename    # Update the filename variable with new name
 
+    def save_session_released(self, event):
+        """
+        Describes behaviour of save session button when the user clicks on it. It saves the path of the loaded image,
+        the steps applied on it and the pixels of the displayed image, so that the edits can be reopened and undone
+        later. If there is no displayed image, it throws up an error
+
+        :param event: User clicks on the button
+        """
+        if self.winfo_containing(event.x_root, event.y_root) == self.save_session_button:  # If clicked area contains
+            # save session button
+            if self.image_present_check():    # If image is present in the stack
+                self.master.preview.cancel()    # An uncommitted preview is not saved, so it is not shown either
+                filename = filedialog.asksaveasfilename(defaultextension=session.SESSION_EXTENSION,
+                                                        filetypes=[("Sessions", '*' + session.SESSION_EXTENSION)])
+                if filename:    # If the user did not cancel the dialog
+                    session.save_session(filename, self.master.images)    # Only the displayed image is stored as
+                    # pixels, the earlier ones are recomputed from the steps when they are undone to
+
+    def open_session_released(self, event):
+        """
+        Describes behaviour of open session button when the user clicks on it. It replaces the stack by the entries of
+        a saved session and displays its last image. The earlier images are only decoded or recomputed when the user
+        undoes back to them
+
+        :param event: User clicks on the button
+        """
+        if self.winfo_containing(event.x_root, event.y_root) == self.open_session_button:  # If clicked area contains
+            # open session button
+            filename = filedialog.askopenfilename(filetypes=[("Sessions", '*' + session.SESSION_EXTENSION)])
+            if filename:    # If a session is selected
+                self.cancel_pending()    # Transforms of the previous image are not needed anymore
+                images = History(self.master.images.budget)    # The current stack is kept until the session opens
+                try:
+                    session.open_session(filename, images)
+                    images[-1]    # Decode or recompute the last image now, to report a moved image
+                except (OSError, ValueError) as error:
+                    images.close()
+                    messagebox.showerror("Error", str(error))
+                    return
+                self.master.images.close()    # The session replaces the stack
+                self.master.images = images
+                loads = [step['path'] for step in self.master.images.steps() if step and step['op'] == 'load']
+                self.master.filename = loads[-1] if loads else filename    # Saving keeps the image's file type
+                self.master.display_image.reset_view()    # Fit the reopened image on the screen
+                self.master.display_image.display_image()    # Display the last image of the session
+
     def undo_last_released(self, event):
         """
         Describes behaviour of undo last button when the user clicks on it. It undos the last transformation that was
@@ -105,14 +259,14 @@ class ToolBar(Frame):
         """
         if self.winfo_containing(event.x_root, event.y_root) == self.undo_last_button:  # If user clicked on area
             # containing the undo last button
+            self.cancel_pending()    # A transform still running would be applied on the undone image
             if len(self.master.images) <= 1:    # If there is less than or equal to 1 image in the stack
                 if len(self.master.images) == 1:    # If there is one image
                     self.master.images.pop()    # remove that image from the stack
                 self.master.display_image.clear_canvas()    # MAke the display screen blank
             else:    # If there are more than one images in the stack
                 self.master.images.pop()    # Remove the most recent image
-                self.master.display_image.display_image(img=self.master.images[-1])  # Display the next most recent
-                # image on the screen
+                self.display_last()    # Display the next most recent image on the screen
 
     def undo_all_released(self, event):
         """
@@ -124,10 +278,10 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.undo_all_button:  # If clicked area contains the
             # undo all button
             if self.image_present_check():    # Continue if images are present in the stack, else throw error messagebox
-                first_img = self.master.images[0]    # The original image in the stack
-                self.master.display_image.display_image(img=first_img)    # Display the first image on the screen
-                self.master.images = [first_img]    # Edit the stack to now contain only the first image, removing
+                self.cancel_pending()    # Transforms still running are not needed anymore
+                self.master.images.reset()    # Edit the stack to now contain only the first image, removing
                 # all the other transformed images
+                self.display_last()    # Display the original image on the screen
 
     def equalize_button_released(self, event):
         """
@@ -139,15 +293,41 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.equalize_button:  # If clicked area contains the
             # equalize button
             if self.image_present_check():    # If stack contains images. Else throw the error message box
-                img = self.master.images[-1]    # Select the displayed image
-                hsv_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)    # Convert it into HSV type
-                transformed_dim = equalisation.histogram_eq(hsv_image[:, :, 2])    # Use the 'V' channel for
-                # transformation. Apply histogram equalization to it
-                hsv_image[:, :, 2] = transformed_dim    # Change the 'V' channel of the original image to the
-                # equalized V channel
-                color_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)    # Convert the image into BGR format
-                self.master.display_image.display_image(img=color_image)    # Display this transformed image
-                self.master.images.append(color_image)    # Append this image to the stack
+                self.apply_point_operation('equalise')    # Apply histogram equalization to the 'V' channel
+
+    def local_equalize_released(self, event):
+        """
+        Describes behaviour of local equalization button when the user clicks on it. It shows a slider for the user to
+        select the size of the neighbourhood, then equalizes the 'V' channel of every region with its own histogram. If
+        screen is blank throws up the error message box
+
+        :param event: User clicks on the button
+        """
+        if self.winfo_containing(event.x_root, event.y_root) == self.local_equalize_button:  # If clicked area
+            # contains the local equalization button
+            if self.image_present_check():    # Check if an image is being displayed
+                self.horizontal = Scale(self, from_=3, to=512, resolution = 1, orient=HORIZONTAL,
+                                        command=self.local_equalize_preview)  # Slider for the size of the window in
+                # pixels. Every move of the slider updates the preview
+                self.horizontal.set(128)
+                self.horizontal.pack()    # Pack it to the GUI
+                window_button = Button(self, text="Set Window", command=self.local_equalize_slide).pack()  # Button
+                # which the user can press to select the window. On clicking it local_equalize_slide is called
+
+    def local_equalize_preview(self, value):
+        """
+        Called on every move of the window slider. Previews the local equalization on a downscaled image
+
+        :param value: Value of the slider
+        """
+        self.master.preview.update('local_equalise', window=float(value))
+
+    def local_equalize_slide(self):
+        """
+        This is called when the window_button is clicked. This performs local histogram equalization on the image.
+        """
+        window_input = self.horizontal.get()    # Get the user input of the window size
+        self.apply_spatial_operation('local_equalise', window=window_input)    # Equalize the 'V' channel locally
 
     def gamma_correct_released(self, event):
         """
@@ -159,25 +339,27 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.gamma_correct_button:  # If clicked area contains
             # the gamma correct button
             if self.image_present_check():    # Check if an image is being displayed
-                self.horizontal = Scale(self, from_=0.00, to=3.00, resolution = 0.25, orient=HORIZONTAL)  # Invoke a
-                # horizontal slider for user to choose gamma
+                self.horizontal = Scale(self, from_=0.00, to=3.00, resolution = 0.25, orient=HORIZONTAL,
+                                        command=self.gamma_preview)  # Invoke a horizontal slider for user to choose
+                # gamma. Every move of the slider updates the preview
                 self.horizontal.pack()    # Pack it to the GUI
                 gamma_button = Button(self, text="Set Gamma", command=self.gamma_slide).pack()    # Button which the
                 # user can press to select gamma. On clicking button, gamma_slide function will be called.
 
+    def gamma_preview(self, value):
+        """
+        Called on every move of the gamma slider. Previews the gamma correction on a downscaled image
+
+        :param value: Value of the slider
+        """
+        self.master.preview.update('gamma', gamma=float(value))
+
     def gamma_slide(self):
         """
         This is called when the gamma_button is clicked. This performs the gamma correct transformation on the image.
         """
         gamma_input = self.horizontal.get()    # Get the user input of gamma
-        img = self.master.images[-1]    # Choose the displayed image to perform gamma correcting
-        hsv_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)    # Convert the BGR to HSV type
-        transformed_dim = gamma.gamma_correct(hsv_image[:, :, 2], gamma_input)   # Perform gamma correcting on the
-        # 'V' channel
-        hsv_image[:, :, 2] = transformed_dim    # Set the 'V' channel of the original image as the gamma corrected one
-        color_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)    # Reconvert back the image to BGR
-        self.master.display_image.display_image(img=color_image)    # Display the reconverted image on the screen
-        self.master.images.append(color_image)    # Append the transformed image to the stack
+        self.apply_point_operation('gamma', gamma=gamma_input)   # Perform gamma correcting on the 'V' channel
 
     def log_transform_released(self, event):
         """
@@ -189,15 +371,7 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.log_transform_button:  # If clicked area contains 
             # the log transform button
             if self.image_present_check():    # Checks if there is a displayed image present, if not throws up error box
-                img = self.master.images[-1]    # The displayed image is selected to be log transformed
-                hsv_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)    # Convert the BGR image to HSV
-                transformed_dim = log_transform.log_trans(hsv_image[:, :, 2])    # Perform log transformation on the 'V'
-                # channel
-                hsv_image[:, :, 2] = transformed_dim  # Set the 'V' channel of the original image as log transformed
-                color_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)    # Re convert the image back to BGR
-                self.master.display_image.display_image(img=color_image)    # Display the transformed image on 
-                # GUI screen
-                self.master.images.append(color_image) # Append the transformed image to the stack
+                self.apply_point_operation('log')    # Perform log transformation on the 'V' channel
 
     def blur_released(self, event):
         """
@@ -209,21 +383,27 @@ class ToolBar(Frame):
         """
         if self.winfo_containing(event.x_root, event.y_root) == self.blur_button:  # If clicked area has the blur button
             if self.image_present_check():    # Check if there is a displayed image else throw an error box
-                self.horizontal = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=HORIZONTAL)    # Invoke a 
-                # slider to take the user input for standard deviation
+                self.horizontal = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=HORIZONTAL,
+                                        command=self.blur_preview)    # Invoke a slider to take the user input for
+                # standard deviation. Every move of the slider updates the preview
                 self.horizontal.pack()    # Pack it onto GUI screen
                 blur_button = Button(self, text="Set STD of Gaussian Window", command=self.blur_slide).pack()  # Button 
                 # for the user to input their chosen value. When the user clicks it blur_slide function is called
 
+    def blur_preview(self, value):
+        """
+        Called on every move of the blur slider. Previews the gaussian blurring on a downscaled image
+
+        :param value: Value of the slider
+        """
+        self.master.preview.update('blur', std=float(value))
+
     def blur_slide(self):
         """
         Function called when the user presses the blur_button. It performs gaussian blurring on the image.
         """
         std_input = self.horizontal.get()  # Get the user STD input
-        img = self.master.images[-1]    # Select the displayed image for transformation
-        blurred_image = blur.gaussian_blur(img, std_input)    # Perform gaussian blurring on the input image
-        self.master.display_image.display_image(img=blurred_image)    # display the blurred image
-        self.master.images.append(blurred_image)    # Append the blurred image to the stack
+        self.apply_spatial_operation('blur', std=std_input)    # Perform gaussian blurring on the displayed image
 
     def sharpening_released(self, event):
         """
@@ -236,15 +416,23 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.sharpening_button: # If clicked area contains the 
             # sharpening button
             if self.image_present_check():   # Check if image is being displayed, if not throw error box.
-                self.horizontal = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=HORIZONTAL) # Slider for 
-                # taking the STD of gaussian kernel
+                self.horizontal = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=HORIZONTAL,
+                                        command=self.sharpen_preview) # Slider for taking the STD of gaussian kernel
                 self.horizontal.pack()    # pack the slider onto GUI screen
-                self.vertical = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=VERTICAL) # Slider for
-                # taking the value of the constant
+                self.vertical = Scale(self, from_=0.00, to=100.00, resolution = 0.5, orient=VERTICAL,
+                                      command=self.sharpen_preview) # Slider for taking the value of the constant
                 self.vertical.pack()    # pack the slider onto GUI screen
                 sharpen_button = Button(self, text="Set sharpening constants", command=self.sharpen_slide).pack()
                 # Button which the user clicks to set the input. On clicking, the sharpen_slide function is called
 
+    def sharpen_preview(self, value):
+        """
+        Called on every move of either sharpening slider. Previews the unsharp masking on a downscaled image
+
+        :param value: Value of the slider which moved
+        """
+        self.master.preview.update('sharpen', std=self.horizontal.get(), c=self.vertical.get())
+
     def sharpen_slide(self):
         """
         Invoked when the sharpen_button is pressed. Performs unsharp masking on the displayed image using gaussian blur
@@ -252,10 +440,8 @@ class ToolBar(Frame):
         """
         std_input = self.horizontal.get()    # Get the std defined by user
         c_input = self.vertical.get()    # get the constant defined by the user
-        img = self.master.images[-1]    # Use the most recent displayed image for sharpening
-        sharpened_image = sharpen.gaussian_unsharp_masking(img, std_input, c_input)    # Apply unsharp masking on image
-        self.master.display_image.display_image(img=sharpened_image)    # display sharpened image
-        self.master.images.append(sharpened_image)     # Append the sharpened image on the stack
+        self.apply_spatial_operation('sharpen', std=std_input, c=c_input)    # Apply unsharp masking on the displayed
+        # image
 
     def edge_detector_released(self, event):
         """
@@ -267,24 +453,26 @@ class ToolBar(Frame):
         if self.winfo_containing(event.x_root, event.y_root) == self.edge_detector_button:  # Clicked area has edge
             # detector button
             if self.image_present_check():    # Check if image is displayed, else throw error message box
-                self.horizontal = Scale(self, from_=0.00, to=255.00, resolution = 0.5, orient=HORIZONTAL)  # Slider for
-                # adjusting the threshold of Sobel Detector
+                self.horizontal = Scale(self, from_=0.00, to=255.00, resolution = 0.5, orient=HORIZONTAL,
+                                        command=self.edge_detect_preview)  # Slider for adjusting the threshold of
+                # Sobel Detector
                 self.horizontal.pack()   # Pack the slider in the GUI window
                 edge_detect_button = Button(self, text = "Set threshold", command = self.edge_detect_slide).pack()
                 # Button for the user to change the threshold. It will call edge_detect_slide whenever
                 # the button is pressed
 
+    def edge_detect_preview(self, value):
+        """
+        Called on every move of the threshold slider. Previews the edge detection on a downscaled image
+
+        :param value: Value of the slider
+        """
+        self.master.preview.update('edge', threshold=float(value))
+
     def edge_detect_slide(self):
         """
         This is called whenever the edge_detect_button is pressed. This performs the sobel edge detection
         on the displayed image
         """
-        img = self.master.images[-1]    # Use the displayed image to perform edge detection
-        gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)    # Convert BGR image to Grayscale
-        transformed_dim = edge_detector.edge_detector(gray_image, self.horizontal.get())    # Perform sobel edge
-        # detection on grayscale image
-        transformed_dim = transformed_dim.astype('float32')  # Convert the transformed image into 8 bit float
-        color_image = cv2.cvtColor(transformed_dim, cv2.COLOR_GRAY2BGR)    # Convert the grayscale transformed image
-        # back to BGR
-        self.master.display_image.display_image(img=color_image)    # Display the edge map
-        self.master.images.append(color_image)    # Append the displayed image to the stack
+        self.apply_spatial_operation('edge', threshold=self.horizontal.get())    # Perform sobel edge detection on the
+        # grayscale version of the displayed image
@@ -1,61 +1,173 @@
 from tkinter import Frame, Canvas, CENTER
-import cv2
-from PIL import ImageTk, Image
+from image_transforms.instrument import stage
+from utils.lazy import lazy_import
+from utils.pyramid import ImagePyramid, PyramidCache
+
+Image = lazy_import('PIL.Image')    # Loaded on first use, so that the window appears without waiting for Pillow
+ImageTk = lazy_import('PIL.ImageTk')
+pipeline = lazy_import('image_transforms.pipeline')
+
+VIEW_SIZE = 750    # Size of the display screen before the window is mapped
+ZOOM_STEP = 1.25    # Zoom factor of one step of the mouse wheel
+MAX_ZOOM = 16.0    # Largest number of screen pixels per image pixel
 
 
 class DisplayImage(Frame):
     """
-    Class extending the tool bar. Used for displaying the image on the GUI screen and clearing the screen.
+    Class extending the tool bar. Used for displaying the image on the GUI screen and clearing the screen. Every image
+    is displayed from a cached pyramid of downsampled copies, and only the visible part of the image is rendered, so
+    zooming with the mouse wheel and panning by dragging cost time in proportion to the screen, not to the image
     """
     def __init__(self, master = None):
         """
         Initializes the parameters which configure the dimensions of the displaying screen and the image size.
         :param master: Inherits from the tool bar class in the main function
         """
-        Frame.__init__(self, master=master, width = 750, height = 750)    # Initializing the display screen size
+        Frame.__init__(self, master=master, width = VIEW_SIZE, height = VIEW_SIZE)    # Initializing the display screen
+        # size
 
         self.displayed_image = None
-        self.canvas = Canvas(self, width = 750, height = 750)    # The canvas size is set
+        self.pyramid = None    # Pyramid of the displayed image
+        self.pyramids = PyramidCache()    # Pyramids of the recently displayed stack entries
+        self.zoom = 1.0    # Zoom relative to the image fitting the screen
+        self.center = (0.5, 0.5)    # Point of the image shown at the centre of the screen, as fractions of its size
+        self._drag = None    # Last mouse position while panning
+
+        self.canvas = Canvas(self, width = VIEW_SIZE, height = VIEW_SIZE)    # The canvas size is set
         self.canvas.place(relx = 0.5, rely = 0.5, anchor = CENTER)    # Placing the canvas such that its center lies
         # in the center of the frame
 
-    def display_image(self, img = None):
+        self.canvas.bind("<MouseWheel>", lambda event: self.zoom_at(event, event.delta > 0))    # Windows and macOS
+        self.canvas.bind("<Button-4>", lambda event: self.zoom_at(event, True))    # Linux
+        self.canvas.bind("<Button-5>", lambda event: self.zoom_at(event, False))
+        self.canvas.bind("<ButtonPress-1>", self.start_pan)
+        self.canvas.bind("<B1-Motion>", self.pan)
+        self.canvas.bind("<Double-Button-1>", lambda event: self.reset_view(render=True))
+
+    def display_image(self, img = None, key = None, cache = True):
         """
-        This function is used to display the image from the stack onto the GUI screen. It adjusts the image if it not
-        fitting on the screen
+        This function is used to display the image from the stack onto the GUI screen. The image fits the screen unless
+        the user zoomed in, in which case the same region of the new image is shown
         :param img: Image to be displayed
+        :param key: Stack entry the image belongs to, the pyramid is cached under it. The image itself if None
+        :param cache: Whether to cache the pyramid, False for images which are displayed once such as previews
         """
-        self.clear_canvas()    # Remove any previous image that is being displayed on the screen
-
         if img is None:    # If no image is passed as argument
             img = self.master.images[-1]    # Use the last image from the stack
+        key = img if key is None else key
 
-        img = img.astype('uint8')    # Convert the image type to 8-bit int, for displaying
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)    # Convert to RGB from BGR
+        def build():
+            with stage('display.materialise'):
+                pixels = pipeline.materialise(img)    # Compute the pixels if the image is a lazy pipeline of operations
+            with stage('display.pyramid'):
+                return ImagePyramid(pixels)
 
-        h, w, _ = img.shape    # Get the height and width of image
-        aspect_ratio = h/w    # Get the aspect ratio = height/width
+        self.pyramid = self.pyramids.get(key, build) if cache else build()
+        self.render()
 
-        if h > self.winfo_height() or w > self.winfo_width():    # If any one dimension is larger than the screen size
-            if aspect_ratio < 1:    # If width > height
-                w = self.winfo_width()    # Adjust width acc to screen size
-                h = int(w*aspect_ratio)   # Adjust height of image according to aspect ratio
+    def view_size(self):
+        """
+        :return: (width, height): Size of the display screen
+        """
+        width, height = self.winfo_width(), self.winfo_height()
+        if width <= 1 or height <= 1:    # The window is not mapped yet
+            return VIEW_SIZE, VIEW_SIZE
+        return width, height
 
-            else:    # If height > width
-                h = self.winfo_height()    # Adjust height acc to screen size
-                w = int(h/aspect_ratio)    # Adjust width acc to aspect ratio
+    def scale(self):
+        """
+        :return: scale: Screen pixels per image pixel at the current zoom
+        """
+        width, height = self.view_size()
+        fit = min(1.0, width/float(self.pyramid.width), height/float(self.pyramid.height))    # Large images are
+        # shrunk to fit the screen, small images are shown at their size
+        return min(MAX_ZOOM, fit * self.zoom)
 
-        self.displayed_image = cv2.resize(img, (h, w))    # Resize the image to be displayed
-        self.displayed_image = ImageTk.PhotoImage(Image.fromarray(self.displayed_image))    # Convert it into image that
-        # can be displayed using TKinter GUI
+    def render(self):
+        """
+        Renders the visible part of the displayed image on the canvas
+        """
+        self.canvas.delete("all")    # Remove any previous image that is being displayed on the screen
+        if self.pyramid is None:
+            return
+        width, height = self.view_size()
+        self._clamp_center()
+        center = (self.center[0] * self.pyramid.width, self.center[1] * self.pyramid.height)
+        with stage('display.render'):
+            rendered = self.pyramid.render(width, height, self.scale(), center)
+        with stage('display.photoimage'):
+            self.displayed_image = ImageTk.PhotoImage(Image.fromarray(rendered))    # Convert it into image
+            # that can be displayed using TKinter GUI
 
+        h, w = rendered.shape[:2]
         self.canvas.config(width=w, height=h)    # Reshape the canvas according to dimensions of the image
         self.canvas.create_image(w/2, h/2, anchor = CENTER, image = self.displayed_image)    # Finally display the image
         # which has the center at the center of the canvas
+        self.master.show_stats()    # Refresh the performance status bar, if it is enabled
+
+    def reset_view(self, render=False):
+        """
+        Fits the whole image on the screen, called when a new image is loaded and on a double click
+
+        :param render: Whether to render the displayed image again
+        """
+        self.zoom = 1.0
+        self.center = (0.5, 0.5)
+        if render:
+            self.render()
+
+    def zoom_at(self, event, zoom_in):
+        """
+        Zooms by one step, keeping the point under the mouse pointer in place
+
+        :param event: Mouse wheel event on the canvas
+        :param zoom_in: Whether to zoom in or out
+        """
+        if self.pyramid is None:
+            return
+        before = self.scale()
+        self.zoom = max(1.0, self.zoom * ZOOM_STEP if zoom_in else self.zoom/ZOOM_STEP)    # No smaller than fitting
+        after = self.scale()
+        dx = event.x - self.canvas.winfo_width()/2.0    # Mouse position relative to the centre of the screen
+        dy = event.y - self.canvas.winfo_height()/2.0
+        self.center = (self.center[0] + dx * (1/before - 1/after)/self.pyramid.width,
+                       self.center[1] + dy * (1/before - 1/after)/self.pyramid.height)
+        self.render()
+
+    def start_pan(self, event):
+        """
+        :param event: Mouse button pressed on the canvas
+        """
+        self._drag = (event.x, event.y)
+
+    def pan(self, event):
+        """
+        Moves the image with the mouse while the button is held
+
+        :param event: Mouse motion on the canvas
+        """
+        if self.pyramid is None or self._drag is None:
+            return
+        scale = self.scale()
+        self.center = (self.center[0] - (event.x - self._drag[0])/(scale * self.pyramid.width),
+                       self.center[1] - (event.y - self._drag[1])/(scale * self.pyramid.height))
+        self._drag = (event.x, event.y)
+        self.render()
+
+    def _clamp_center(self):
+        """
+        Keeps the visible region inside the image
+        """
+        width, height = self.view_size()
+        scale = self.scale()
+        half_x = min(0.5, width/(2.0 * scale * self.pyramid.width))    # Half of the visible fraction of the image
+        half_y = min(0.5, height/(2.0 * scale * self.pyramid.height))
+        self.center = (min(max(self.center[0], half_x), 1 - half_x), min(max(self.center[1], half_y), 1 - half_y))
 
     def clear_canvas(self):
         """
         This function helps to clear the canvas if any image is being displayed on it,
         for the next image to be displayed
         """
+        self.pyramid = None
         self.canvas.delete("all")    # Delete all the image pixels that are currently using the canvas
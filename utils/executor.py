@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import messagebox
+
+DEFAULT_WORKERS = 2    # One thread for the current job, one for a superseded job which is still finishing
+POLL_INTERVAL = 20    # Milliseconds between two checks of the running jobs
+
+
+class TransformExecutor(object):
+    """
+    Runs transforms on a thread pool so that the Tk mainloop never blocks. NumPy and OpenCV release the GIL in their
+    heavy loops, so the GUI stays responsive while a job runs. Results are handed back on the Tk thread through
+    after() callbacks. Jobs are submitted under a key, and a new job under the same key supersedes the older one:
+    it is cancelled if it has not started yet, and its result is discarded otherwise
+    """
+    def __init__(self, master, workers=DEFAULT_WORKERS, on_busy=None):
+        """
+        :param master: Tk widget used to schedule the callbacks on the Tk thread
+        :param workers: Number of worker threads
+        :param on_busy: Called with True when the first job starts and with False when the last job finishes
+        """
+        self.master = master
+        self.on_busy = on_busy
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}    # key -> (future, on_done, on_error) of the latest job submitted under that key
+        self._polling = None    # Identifier of the scheduled poll, None if no poll is scheduled
+
+    @property
+    def busy(self):
+        """
+        :return: busy: Whether any job is in flight
+        """
+        return bool(self._jobs)
+
+    def submit(self, key, function, *args, on_done=None, on_error=None):
+        """
+        Runs function(*args) on a worker thread, superseding the previous job submitted under the same key
+
+        :param key: Jobs with the same key supersede each other
+        :param function: Function to run
+        :param args: Arguments of the function
+        :param on_done: Called on the Tk thread with the result of the function
+        :param on_error: Called on the Tk thread with the exception raised by the function. Shows an error box if None
+        :return: future: The future of the job
+        """
+        previous = self._jobs.pop(key, None)
+        if previous is not None:    # The older job is superseded
+            previous[0].cancel()
+        future = self._pool.submit(function, *args)
+        self._jobs[key] = (future, on_done, on_error)
+        if self._polling is None:    # No job was in flight until now
+            self._polling = self.master.after(POLL_INTERVAL, self._poll)
+            if self.on_busy is not None:
+                self.on_busy(True)
+        return future
+
+    def cancel(self, key=None):
+        """
+        Cancels the job submitted under a key, or every job. A job which has already started runs to completion on
+        its thread, but its result is discarded
+
+        :param key: Key of the job, None to cancel every job
+        """
+        keys = list(self._jobs) if key is None else [key]
+        for k in keys:
+            job = self._jobs.pop(k, None)
+            if job is not None:
+                job[0].cancel()
+        if keys and not self._jobs:
+            self._stop_polling()
+
+    def shutdown(self):
+        """
+        Cancels every job and stops the worker threads
+        """
+        self.cancel()
+        self._pool.shutdown(wait=False)
+
+    def _stop_polling(self):
+        """
+        Unschedules the poll and reports that no job is in flight
+        """
+        if self._polling is not None:
+            self.master.after_cancel(self._polling)
+            self._polling = None
+            if self.on_busy is not None:
+                self.on_busy(False)
+
+    def _poll(self):
+        """
+        Runs on the Tk thread. Hands the results of the finished jobs to their callbacks
+        """
+        self._polling = None
+        for key, (future, on_done, on_error) in list(self._jobs.items()):
+            if not future.done():
+                continue
+            del self._jobs[key]
+            error = future.exception()
+            if error is not None:
+                if on_error is not None:
+                    on_error(error)
+                else:
+                    messagebox.showerror("Error", str(error))
+            elif on_done is not None:
+                on_done(future.result())
+
+        if self._jobs:    # Check again later for the jobs still running
+            self._polling = self.master.after(POLL_INTERVAL, self._poll)
+        elif self.on_busy is not None:
+            self.on_busy(False)
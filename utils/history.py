@@ -0,0 +1,208 @@
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')    # Only needed once an image is in the stack
+pipeline = lazy_import('image_transforms.pipeline')
+
+DEFAULT_BUDGET = 1024 ** 3    # Bytes of image data that the history keeps in RAM before spilling entries to disk
+
+
+class LazyEntry(object):
+    """
+    Entry of the stack whose image is only produced when it is first accessed, e.g. an earlier state of a reopened
+    session which is decoded or recomputed once the user undoes back to it
+    """
+    def __init__(self, build):
+        """
+        :param build: Called without arguments to produce the image or lazy pipeline of the entry
+        """
+        self.build = build
+
+
+class History(object):
+    """
+    The stack of images that have been displayed, used for the undo buttons. Only a bounded number of bytes is kept
+    in RAM: once the budget is exceeded the oldest entries are written to memory mapped files in a temporary
+    directory, and they are paged back in by the OS when they are displayed again. The original image and the most
+    recent image always stay in RAM, so that undoing all the changes and displaying the current image are O(1).
+    Every entry also records the step which produced it, in the format of Pipeline.recipe, so that the stack can be
+    saved as a session and replayed. Lazy entries may be produced on the worker threads, so the bookkeeping is
+    guarded by a lock, which is not held while an entry is built
+    """
+    def __init__(self, budget=DEFAULT_BUDGET, spill_dir=None):
+        """
+        :param budget: Maximum number of bytes of image data kept in RAM
+        :param spill_dir: Directory in which the spilled entries are stored. A temporary directory if None
+        """
+        self.budget = budget
+        self._spill_root = spill_dir
+        self._spill_dir = None    # Created the first time an entry is spilled
+        self._entries = []    # The images, or lazy pipelines of operations on images lower in the stack
+        self._paths = []    # Path of the file backing every entry, None if the entry is in RAM
+        self._steps = []    # Step which produced every entry, e.g. {"op": "gamma", "gamma": 1.5}, None if unknown
+        self._counter = 0    # Used to give unique names to the spilled files
+        self._finalizer = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        with self._lock:
+            index = range(len(self._entries))[index]    # Negative indices are resolved before the stack can change
+            entry = self._entries[index]
+        if not isinstance(entry, LazyEntry):
+            return entry
+        image = entry.build()    # Produced on first access and kept. Not under the lock, replaying the steps may take
+        # long and the stack must stay usable meanwhile
+        with self._lock:
+            if index < len(self._entries) and self._entries[index] is entry:    # Not popped while it was built
+                self._entries[index] = image
+                if _resident_bytes(image):    # Pipelines and memory maps do not change the usage
+                    self._enforce_budget()
+        return image
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self._entries)))
+
+    def append(self, image, step=None):
+        """
+        Pushes an image on the stack, spilling older entries to disk if the budget is exceeded
+
+        :param image: Image, lazy pipeline or LazyEntry
+        :param step: Step which produced the image from the entry below it, e.g. {"op": "blur", "std": 2}, or
+         {"op": "load", "path": ...} for a loaded image
+        """
+        with self._lock:
+            self._entries.append(image)
+            self._paths.append(None)
+            self._steps.append(step)
+            self._enforce_budget()
+
+    def steps(self):
+        """
+        :return: steps: The step which produced every entry, oldest first
+        """
+        return list(self._steps)
+
+    def is_loaded(self, index):
+        """
+        :param index: Index of the entry
+        :return: loaded: False if the entry is a LazyEntry which was not accessed yet
+        """
+        return not isinstance(self._entries[index], LazyEntry)
+
+    def pop(self):
+        """
+        Removes the most recent entry of the stack
+
+        :return: image: The removed image
+        """
+        with self._lock:
+            image = self._entries.pop()
+            self._remove_file(self._paths.pop())
+            self._steps.pop()
+        return image
+
+    def reset(self):
+        """
+        Removes every entry except the original image
+        """
+        with self._lock:
+            del self._entries[1:]
+            for path in self._paths[1:]:
+                self._remove_file(path)
+            del self._paths[1:]
+            del self._steps[1:]
+
+    def clear(self):
+        """
+        Removes every entry of the stack
+        """
+        with self._lock:
+            self._entries = []
+            for path in self._paths:
+                self._remove_file(path)
+            self._paths = []
+            self._steps = []
+
+    def memory_usage(self):
+        """
+        :return: nbytes: Number of bytes of image data held in RAM
+        """
+        return sum(_resident_bytes(image) for image in self._entries)
+
+    def close(self):
+        """
+        Removes the spilled files. The history is empty afterwards
+        """
+        self.clear()
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def _enforce_budget(self):
+        """
+        Spills the oldest entries held in RAM until the budget is met. The first and last entries are never spilled
+        """
+        usage = self.memory_usage()
+        for index in range(1, len(self._entries) - 1):
+            if usage <= self.budget:
+                break
+            nbytes = _resident_bytes(self._entries[index])
+            if nbytes:
+                self._spill(index)
+                usage -= nbytes
+
+    def _spill(self, index):
+        """
+        Writes an entry to a memory mapped file and replaces it by a read only view of the file
+
+        :param index: Index of the entry
+        """
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='ee610_history_', dir=self._spill_root)
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self._spill_dir, True)    # Cleaned up with the
+            # history, even if close is never called
+
+        image = self._entries[index]
+        path = os.path.join(self._spill_dir, 'entry_%d.npy' % self._counter)
+        self._counter += 1
+        mapped = np.lib.format.open_memmap(path, mode='w+', dtype=image.dtype, shape=image.shape)
+        mapped[...] = image
+        mapped.flush()
+        del mapped
+        spilled = np.load(path, mmap_mode='r')
+
+        for i in range(index + 1, len(self._entries)):    # Pipelines above the entry must not keep it in RAM
+            entry = self._entries[i]
+            if isinstance(entry, pipeline.Pipeline) and entry.source is image:
+                self._entries[i] = pipeline.Pipeline(spilled, entry.operations)
+        self._entries[index] = spilled
+        self._paths[index] = path
+
+    @staticmethod
+    def _remove_file(path):
+        """
+        Deletes the file backing a spilled entry. Views which are still open keep working until they are released
+
+        :param path: Path of the file, or None for entries held in RAM
+        """
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def _resident_bytes(image):
+    """
+    Number of bytes of an entry held in RAM. Pipelines only reference images lower in the stack, memory mapped
+    images live on disk and lazy entries are not produced yet, so they count as zero
+
+    :param image: Image, lazy pipeline or LazyEntry
+    :return: nbytes: Number of bytes
+    """
+    if isinstance(image, np.memmap) or not isinstance(image, np.ndarray):
+        return 0
+    return image.nbytes
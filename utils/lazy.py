@@ -0,0 +1,66 @@
+import importlib
+import threading
+
+WARM_UP_MODULES = ('numpy', 'cv2', 'PIL.Image', 'PIL.ImageTk', 'image_transforms.pipeline')    # Heavy modules used
+# by the editor, in the order they are needed
+
+
+class LazyModule(object):
+    """
+    Stands in for a module which is only imported when one of its attributes is first used, e.g.
+    cv2 = lazy_import('cv2') at the top of a file and cv2.imread(...) in a function. Keeps heavy libraries off the
+    startup path of the GUI
+    """
+    def __init__(self, name):
+        """
+        :param name: Full name of the module
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """
+        :return: module: The imported module. Python's import lock makes concurrent first uses safe
+        """
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return "<lazy module '%s'%s>" % (self.__dict__['_name'], '' if self.__dict__['_module'] is None else ' (loaded)')
+
+
+def lazy_import(name):
+    """
+    :param name: Full name of the module, e.g. 'PIL.ImageTk'
+    :return: module: Module which is imported on first use
+    """
+    return LazyModule(name)
+
+
+def warm_up(names=WARM_UP_MODULES):
+    """
+    Imports modules on a background thread, started once the window is shown so that the libraries are usually
+    loaded by the time the user opens an image. A module the GUI needs before the thread reaches it is imported on
+    the Tk thread instead, which waits for the background import if it is already in progress
+
+    :param names: Full names of the modules
+    :return: thread: The daemon thread importing the modules
+    """
+    def run():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:    # Reported when the module is actually used
+                pass
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
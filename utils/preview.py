@@ -0,0 +1,116 @@
+import threading
+import weakref
+from utils.lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+pipeline = lazy_import('image_transforms.pipeline')
+storage = lazy_import('image_transforms.storage')
+
+PROXY_SIZE = 750    # Largest side of the proxy. The canvas never shows more pixels than this
+DEBOUNCE_DELAY = 50    # Milliseconds the slider has to stay still before the preview is rendered
+SCALED_PARAMS = {'blur': ('std',), 'sharpen': ('std',), 'local_equalise': ('window',)}    # Parameters measured
+# in pixels, which shrink with the proxy
+
+
+class Preview(object):
+    """
+    Live preview of the operations while their sliders are being moved. The operation is applied on a downscaled
+    proxy of the displayed image, and slider moves are debounced and coalesced so that only the latest value is
+    computed. Nothing is pushed on the stack, the full resolution transform only runs when the edit is committed
+    """
+    def __init__(self, master, proxy_size=PROXY_SIZE, delay=DEBOUNCE_DELAY):
+        """
+        :param master: The main window. Provides the image stack, the executor and the display
+        :param proxy_size: Largest side of the proxy
+        :param delay: Debouncing delay of the slider moves in milliseconds
+        """
+        self.master = master
+        self.proxy_size = proxy_size
+        self.delay = delay
+        self._scheduled = None    # Identifier of the pending after() callback
+        self._lock = threading.Lock()    # The proxy is built on the worker threads
+        self._source = None    # Weak reference to the stack entry the cached proxy was built from, so that an entry
+        # popped or spilled by the history is not kept in RAM by the preview
+        self._proxy = None
+        self._scale = 1.0
+        self.showing = False    # Whether a preview is on the screen instead of the last image of the stack
+
+    def proxy(self, entry):
+        """
+        Downscaled pixels of a stack entry. Cached until a different entry is requested or the entry is released
+
+        :param entry: Image or lazy pipeline from the stack
+        :return: (proxy, scale): Downscaled image and the ratio of its size to the size of the original
+        """
+        with self._lock:
+            if self._source is None or self._source() is not entry:
+                img = storage.working(pipeline.materialise(entry))    # OpenCV does not resize float16 images
+                h, w = img.shape[:2]
+                scale = min(1.0, float(self.proxy_size)/max(h, w))
+                if scale < 1.0:    # Area interpolation averages the pixels which are merged together
+                    img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))),
+                                     interpolation=cv2.INTER_AREA)
+                elif img is entry:    # A small image is its own proxy, copied so that the entry can be released
+                    img = img.copy()
+                self._source, self._proxy, self._scale = weakref.ref(entry), img, scale
+            return self._proxy, self._scale
+
+    def update(self, name, **params):
+        """
+        Called on every slider move. Renders the operation on the proxy once the slider has been still for a while
+
+        :param name: Name of the operation, a key of POINT_OPERATIONS or SPATIAL_OPERATIONS
+        :param params: Parameters of the operation
+        """
+        if not self.master.images:    # Nothing to preview
+            return
+        if self._scheduled is not None:    # Only the latest value of the slider is rendered
+            self.master.after_cancel(self._scheduled)
+        self._scheduled = self.master.after(self.delay, lambda: self._render(name, params))
+
+    def cancel(self, restore=True):
+        """
+        Drops the pending preview, called when the edit is committed or abandoned
+
+        :param restore: Whether to display the last image of the stack again if a preview is on the screen. False when
+         the edit is committed, the preview then stays until the full resolution result replaces it
+        """
+        if self._scheduled is not None:
+            self.master.after_cancel(self._scheduled)
+            self._scheduled = None
+        self.master.executor.cancel('preview')
+        if self.showing:
+            self.showing = False
+            if restore and self.master.images:    # The screen shows what would be saved, from the cached pyramid
+                self.master.display_image.display_image(img=self.master.images[-1])
+
+    def _show(self, img):
+        """
+        Displays a rendered preview without caching its pyramid
+
+        :param img: Pixels of the preview
+        """
+        self.showing = True
+        self.master.display_image.display_image(img=img, cache=False)
+
+    def _render(self, name, params):
+        """
+        Applies the operation on the proxy in the background and displays the result without storing it
+
+        :param name: Name of the operation
+        :param params: Parameters of the operation
+        """
+        self._scheduled = None
+        images, index = self.master.images, len(self.master.images) - 1    # The entry is read on the worker, an entry
+        # of a reopened session may have to be recomputed first
+
+        def job():
+            proxy, scale = self.proxy(images[index])
+            scaled = dict(params)
+            for key in SCALED_PARAMS.get(name, ()):    # Blurring 1 pixel of the proxy blurs 1/scale original pixels
+                scaled[key] = params[key] * scale
+            return pipeline.Pipeline(proxy).then(name, **scaled).materialise()
+
+        self.master.executor.submit('preview', job, on_done=self._show,
+                                    on_error=lambda error: None)    # Invalid slider values are only reported when
+        # the edit is committed
@@ -0,0 +1,143 @@
+import threading
+import weakref
+from collections import OrderedDict
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+MIN_LEVEL_SIZE = 64    # The pyramid stops once the largest side of a level is below this
+CACHE_BUDGET = 256 * 1024 ** 2    # Bytes of pyramids kept by a PyramidCache
+
+
+class ImagePyramid(object):
+    """
+    Multi resolution copy of an image, ready for display: 8 bit RGB at full resolution and at every power of two
+    below it. Rendering a viewport only touches the level closest to the zoom, so its cost depends on the size of
+    the screen and not on the size of the image
+    """
+    def __init__(self, img):
+        """
+        :param img: BGR image of any dtype, values in [0, 255]
+        """
+        img = np.clip(img, 0, 255).astype('uint8', copy=False) if img.dtype != np.uint8 else img    # Convert the
+        # image type to 8-bit int, for displaying
+        self.levels = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB)]    # Convert to RGB from BGR
+        while max(self.levels[-1].shape[:2]) > MIN_LEVEL_SIZE:    # Every level halves the previous one
+            self.levels.append(cv2.pyrDown(self.levels[-1]))
+        self.height, self.width = img.shape[:2]
+        self.nbytes = sum(level.nbytes for level in self.levels)
+
+    def level_for(self, zoom):
+        """
+        Chooses the smallest level which still has at least one pixel per displayed pixel
+
+        :param zoom: Displayed pixels per pixel of the full resolution image
+        :return: index: Index of the level
+        """
+        index = 0
+        while index + 1 < len(self.levels) and zoom <= 0.5 ** (index + 1):
+            index += 1
+        return index
+
+    def render(self, view_width, view_height, zoom, center):
+        """
+        Renders the part of the image visible in a viewport
+
+        :param view_width: Width of the viewport in screen pixels
+        :param view_height: Height of the viewport in screen pixels
+        :param zoom: Displayed pixels per pixel of the full resolution image
+        :param center: (x, y) point of the full resolution image shown at the centre of the viewport
+        :return: rendered: RGB image of at most view_height x view_width pixels
+        """
+        src_w = min(self.width, view_width/zoom)    # Size of the visible region in full resolution pixels
+        src_h = min(self.height, view_height/zoom)
+        x0 = int(np.clip(center[0] - src_w/2, 0, self.width - src_w))    # The region stays inside the image
+        y0 = int(np.clip(center[1] - src_h/2, 0, self.height - src_h))
+        x1 = min(self.width, x0 + int(np.ceil(src_w)))
+        y1 = min(self.height, y0 + int(np.ceil(src_h)))
+
+        level = self.levels[self.level_for(zoom)]
+        scale_y = level.shape[0]/float(self.height)    # Size of the level relative to the full resolution
+        scale_x = level.shape[1]/float(self.width)
+        crop = level[int(y0 * scale_y):max(int(y0 * scale_y) + 1, int(np.ceil(y1 * scale_y))),
+                     int(x0 * scale_x):max(int(x0 * scale_x) + 1, int(np.ceil(x1 * scale_x)))]
+
+        out_w = max(1, min(view_width, int(round((x1 - x0) * zoom))))
+        out_h = max(1, min(view_height, int(round((y1 - y0) * zoom))))
+        if (out_h, out_w) == crop.shape[:2]:
+            return crop
+        interpolation = cv2.INTER_AREA if out_w < crop.shape[1] else cv2.INTER_NEAREST    # Pixels stay sharp when
+        # zooming in
+        return cv2.resize(crop, (out_w, out_h), interpolation=interpolation)    # cv2 takes (width, height)
+
+
+class PyramidCache(object):
+    """
+    Pyramids of the most recently displayed stack entries, so that undoing back to an entry does not convert and
+    resample its pixels again. The entries are only weakly referenced: a pyramid is dropped as soon as its entry leaves
+    the stack, e.g. when it is popped or replaced by a memory mapped copy, so the cache never keeps pixels in RAM which
+    the history released. The pyramids kept are also bounded by bytes
+    """
+    def __init__(self, budget=CACHE_BUDGET):
+        """
+        :param budget: Maximum number of bytes of pyramids kept
+        """
+        self.budget = budget
+        self.nbytes = 0    # Bytes of the pyramids currently held
+        self._pyramids = OrderedDict()    # id(key) -> (weak reference to the key, pyramid), least recently used first
+        self._lock = threading.Lock()    # The last reference to an entry may be dropped on a worker thread
+        self._dead = []    # Weak references whose entry was collected, their pyramids are dropped by the next get
+
+    def get(self, key, build):
+        """
+        :param key: Stack entry the pyramid belongs to
+        :param build: Called without arguments to build the pyramid if it is not cached
+        :return: pyramid: Cached or newly built pyramid
+        """
+        with self._lock:
+            self._drop_dead()
+            cached = self._pyramids.get(id(key))
+            if cached is not None and cached[0]() is key:
+                self._pyramids.move_to_end(id(key))
+                return cached[1]
+        pyramid = build()
+        try:
+            reference = weakref.ref(key, self._forget)
+        except TypeError:    # Objects which cannot be weakly referenced are not cached
+            return pyramid
+        with self._lock:
+            self._drop_dead()
+            self._discard(id(key))
+            self._pyramids[id(key)] = (reference, pyramid)
+            self.nbytes += pyramid.nbytes
+            while self.nbytes > self.budget and len(self._pyramids) > 1:    # The newest pyramid is always kept
+                self._discard(next(iter(self._pyramids)))
+        return pyramid
+
+    def _forget(self, reference):
+        """
+        Called by the garbage collector when an entry is collected. It may run on any thread, also while get holds the
+        lock on the same thread, so it only records the reference: taking the lock could deadlock
+
+        :param reference: The dead weak reference to the entry
+        """
+        self._dead.append(reference)    # Atomic, no lock needed
+
+    def _drop_dead(self):
+        """
+        Drops the pyramids of the entries which were garbage collected. The lock must be held
+        """
+        while self._dead:
+            reference = self._dead.pop()
+            for ident, (cached, _) in list(self._pyramids.items()):
+                if cached is reference:
+                    self._discard(ident)
+
+    def _discard(self, ident):
+        """
+        :param ident: id of the entry whose pyramid is removed, if it is cached. The lock must be held
+        """
+        cached = self._pyramids.pop(ident, None)
+        if cached is not None:
+            self.nbytes -= cached[1].nbytes
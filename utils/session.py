@@ -0,0 +1,183 @@
+import json
+import os
+import struct
+import zipfile
+from utils.history import LazyEntry
+from utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+pipeline = lazy_import('image_transforms.pipeline')
+
+SESSION_EXTENSION = '.session'    # Extension of the session files
+SESSION_VERSION = 1    # Version of the session format, stored in the file
+MANIFEST = 'session.json'    # Member of the session file holding the steps and the index of the snapshots
+CHUNK_ROWS = 256    # Rows of an image stored in one compressed chunk
+COMPRESS_LEVEL = 1    # zlib level of the compressed snapshots, fast to write and to decode
+LOCAL_HEADER = struct.Struct('<4s22xHH')    # Signature, then the lengths of the name and extra field of a zip member
+
+
+def save_session(path, history, snapshots=(-1,), compress=True):
+    """
+    Saves the undo stack as a session. A session is a zip file holding the step which produced every entry, starting
+    with the path of the loaded image, and snapshots of the pixels of selected entries. A snapshot is either split in
+    bands of CHUNK_ROWS rows which are compressed separately, or stored uncompressed so that it can be memory mapped
+    straight from the session file. Entries without a recorded step are always stored as snapshots
+
+    :param path: Path of the session file, replaced atomically
+    :param history: The History to save
+    :param snapshots: Indices of the entries whose pixels are stored, the current image by default
+    :param compress: Whether to compress the snapshots, else they are memory mapped when the session is opened
+    """
+    steps = history.steps()
+    selected = {index % len(steps) for index in snapshots if -len(steps) <= index < len(steps)}
+    selected.update(index for index, step in enumerate(steps) if step is None)
+    manifest = {'version': SESSION_VERSION, 'steps': steps, 'snapshots': {}}
+
+    temporary = path + '.tmp'
+    with zipfile.ZipFile(temporary, 'w', compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+                         compresslevel=COMPRESS_LEVEL) as archive:
+        for index in sorted(selected):
+            img = pipeline.materialise(history[index])
+            name = 'snapshots/%d' % index
+            if compress:
+                chunks = []
+                for start in range(0, img.shape[0], CHUNK_ROWS):
+                    chunks.append('%s/%d.npy' % (name, start))
+                    _write_array(archive, chunks[-1], img[start:start + CHUNK_ROWS])
+            else:
+                chunks = [name + '.npy']
+                _write_array(archive, chunks[0], img)
+            manifest['snapshots'][str(index)] = {'shape': list(img.shape), 'dtype': img.dtype.str,
+                                                 'compressed': compress, 'chunks': chunks}
+        archive.writestr(MANIFEST, json.dumps(manifest, indent=1), compress_type=zipfile.ZIP_DEFLATED)
+    os.replace(temporary, path)
+
+
+def open_session(path, history):
+    """
+    Reopens a session into an empty undo stack. Every entry is a LazyEntry: the current image is produced when it is
+    displayed, from its snapshot or by replaying its step on the entry below it, and earlier entries are only
+    decoded or recomputed when the user undoes back to them
+
+    :param path: Path of the session file
+    :param history: Empty History which receives the entries
+    :return: history: The filled History
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            manifest = json.loads(archive.read(MANIFEST).decode('utf-8'))
+    except (zipfile.BadZipFile, KeyError):
+        raise ValueError("'%s' is not a valid session file" % path)
+    if manifest.get('version') != SESSION_VERSION:
+        raise ValueError("'%s' has an unsupported session version %r" % (path, manifest.get('version')))
+    if not manifest.get('steps'):
+        raise ValueError("'%s' has no images" % path)
+
+    snapshots = manifest['snapshots']
+    for index, step in enumerate(manifest['steps']):
+        if str(index) not in snapshots and step is None:
+            raise ValueError("'%s' has neither the step nor a snapshot of entry %d" % (path, index))
+
+    def build(index, step):
+        snapshot = snapshots.get(str(index))
+        if snapshot is not None:
+            return read_snapshot(path, snapshot)
+        start = index    # The entries below are produced from the nearest one which is loaded or has a snapshot,
+        # upwards, so that every replay finds the entry below it loaded and nothing recurses
+        while start > 0 and not history.is_loaded(start - 1) and str(start - 1) not in snapshots:
+            start -= 1
+        for below in range(max(start - 1, 0), index):
+            history[below]
+        return replay_step(history[index - 1] if index else None, step, os.path.dirname(path))
+
+    for index, step in enumerate(manifest['steps']):
+        history.append(LazyEntry(lambda index=index, step=step: build(index, step)), step)    # The step is bound
+        # now, the entry may be popped while it is replayed on a worker thread
+    return history
+
+
+def replay_step(entry, step, session_dir=''):
+    """
+    Produces an entry of the stack from the entry below it, the same way as the tool bar does
+
+    :param entry: Image or lazy pipeline below the produced entry, None for the first entry
+    :param step: Recorded step, e.g. {"op": "gamma", "gamma": 1.5} or {"op": "load", "path": ...}
+    :param session_dir: Directory of the session file, searched for the loaded image if it moved
+    :return: entry: The image, or a lazy pipeline for point operations
+    """
+    params = dict(step)
+    name = params.pop('op')
+    if name == 'load':
+        return _load_image(params['path'], session_dir)
+    if entry is None:
+        raise ValueError("The first step of a session must load an image, not '%s'" % name)
+    if name in pipeline.POINT_OPERATIONS:    # Recorded on a lazy pipeline, as in ToolBar.apply_point_operation
+        source = entry if isinstance(entry, pipeline.Pipeline) else pipeline.Pipeline(entry)
+        return source.then(name, **params)
+    return pipeline.apply_spatial_operation(name, pipeline.materialise(entry), **params)
+
+
+def read_snapshot(path, snapshot):
+    """
+    :param path: Path of the session file
+    :param snapshot: Description of the snapshot in the manifest
+    :return: img: The pixels, a read only memory map of the session file if the snapshot is uncompressed
+    """
+    with zipfile.ZipFile(path) as archive:
+        if not snapshot['compressed']:
+            return _map_array(path, archive.getinfo(snapshot['chunks'][0]))
+        img = np.empty(snapshot['shape'], dtype=np.dtype(snapshot['dtype']))
+        start = 0
+        for chunk in snapshot['chunks']:    # Decoded band by band into the image
+            with archive.open(chunk) as f:
+                band = np.lib.format.read_array(f)
+            img[start:start + band.shape[0]] = band
+            start += band.shape[0]
+        return img
+
+
+def _write_array(archive, name, img):
+    """
+    :param archive: Zip file open for writing, its compression is used for the member
+    :param name: Name of the member
+    :param img: Array stored in the .npy format
+    """
+    with archive.open(name, 'w', force_zip64=True) as f:    # Streamed, the array is not copied into a bytes object
+        np.lib.format.write_array(f, np.ascontiguousarray(img), allow_pickle=False)
+
+
+def _map_array(path, info):
+    """
+    Memory maps an uncompressed .npy member of a zip file
+
+    :param path: Path of the zip file
+    :param info: ZipInfo of the member
+    :return: img: Read only memory map of the array
+    """
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        signature, name_length, extra_length = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        if signature != b'PK\x03\x04':
+            raise ValueError("'%s' is not a valid session file" % path)
+        f.seek(info.header_offset + LOCAL_HEADER.size + name_length + extra_length)    # Start of the member data
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+            np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
+
+
+def _load_image(path, session_dir):
+    """
+    :param path: Path of the loaded image when the session was saved
+    :param session_dir: Directory of the session file, searched for an image of the same name if the path is gone
+    :return: img: The image, as 8 bit ints like the load button reads it
+    """
+    if not os.path.exists(path):
+        path = os.path.join(session_dir, os.path.basename(path))
+    img = cv2.imread(path)
+    if img is None:
+        raise OSError("Could not read the image '%s' of the session" % path)
+    return img
@@ -0,0 +1,291 @@
+import argparse
+import queue
+import sys
+import threading
+import time
+import numpy as np
+import cv2
+from batch import load_recipe
+from image_transforms.pipeline import Pipeline
+from image_transforms.storage import compact
+
+DEFAULT_QUEUE = 8    # Frames each queue between two stages holds before the stage feeding it waits
+DEFAULT_FPS = 30.0    # Frame rate of the output when the input does not report one, e.g. for frame sequences
+DEFAULT_CODEC = 'mp4v'    # FourCC of the output video
+REPORT_INTERVAL = 1.0    # Seconds between two progress lines
+POLL_TIMEOUT = 0.1    # Seconds a blocked stage waits before checking whether the stream was stopped
+
+_END = object()    # Marks the end of the stream in the queues
+
+
+class BufferPool(object):
+    """
+    Fixed set of frame buffers which the decoder reads into. A buffer goes back to the pool once its frame has been
+    transformed, so no frame sized array is allocated per decoded frame
+    """
+    def __init__(self, buffers):
+        """
+        :param buffers: Preallocated frames
+        """
+        self._free = queue.Queue()
+        for buffer in buffers:
+            self._free.put(buffer)
+
+    def acquire(self):
+        """
+        :return: buffer: A free buffer. Waits until one is released if there is none
+        """
+        return self._free.get()
+
+    def release(self, buffer):
+        """
+        :param buffer: Buffer which is not used anymore
+        """
+        self._free.put(buffer)
+
+
+class SequenceWriter(object):
+    """
+    Writes frames as numbered images, with the same interface as cv2.VideoWriter
+    """
+    def __init__(self, pattern, start=0):
+        """
+        :param pattern: Path with a printf style index, e.g. 'out/frame_%04d.png'
+        :param start: Index of the first frame
+        """
+        self.pattern = pattern
+        self.index = start
+
+    def write(self, frame):
+        """
+        :param frame: 8 bit BGR frame
+        """
+        path = self.pattern % self.index
+        if not cv2.imwrite(path, frame):
+            raise OSError("Could not write '%s'" % path)
+        self.index += 1
+
+    def release(self):
+        pass
+
+
+def open_writer(path, fps, frame_size, codec=DEFAULT_CODEC):
+    """
+    :param path: Output video, or numbered image pattern such as 'out/frame_%04d.png'
+    :param fps: Frame rate of the output video
+    :param frame_size: (width, height) of the frames
+    :param codec: FourCC of the output video
+    :return: writer: Object with write(frame) and release() methods
+    """
+    if '%' in path:
+        return SequenceWriter(path)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, frame_size)
+    if not writer.isOpened():
+        raise OSError("Could not open '%s' for writing with codec '%s'" % (path, codec))
+    return writer
+
+
+def _put(channel, item, stop):
+    """
+    Puts an item on a bounded queue, waiting while it is full. This is the backpressure: a fast stage waits for the
+    slower one after it instead of dropping frames
+
+    :param channel: Queue
+    :param item: Item
+    :param stop: Event set when the stream is stopped
+    :return: put: False if the stream was stopped before the item could be put
+    """
+    while True:
+        try:
+            channel.put(item, timeout=POLL_TIMEOUT)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _get(channel, stop):
+    """
+    :param channel: Queue
+    :param stop: Event set when the stream is stopped
+    :return: item: Next item of the queue, or None if the stream was stopped
+    """
+    while True:
+        try:
+            return channel.get(timeout=POLL_TIMEOUT)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
+
+def transform_frame(frame, recipe):
+    """
+    Applies the recipe on one frame. Frames are never repeated, so the transform cache is bypassed
+
+    :param frame: 8 bit BGR frame
+    :param recipe: List of steps
+    :return: frame: Transformed 8 bit BGR frame
+    """
+    return compact(Pipeline.from_recipe(frame, recipe).materialise(cache=None))
+
+
+def run_stream(recipe, source, destination, workers=1, queue_size=DEFAULT_QUEUE, fps=None, codec=DEFAULT_CODEC,
+               log=print):
+    """
+    Applies a recipe on every frame of a video or numbered frame sequence. Decoding, transforming and encoding run on
+    separate threads connected by bounded queues, so the three stages overlap. The decoder reads into a pool of
+    reusable buffers. A stage which runs ahead waits for the next one, every frame is written, in order
+
+    :param recipe: List of steps
+    :param source: Input video, or numbered image pattern such as 'frames/frame_%04d.png'
+    :param destination: Output video, or numbered image pattern
+    :param workers: Number of threads transforming frames concurrently. The transforms also use several cores each
+    :param queue_size: Capacity of the queues between the stages
+    :param fps: Frame rate of the output, the one of the input if None
+    :param codec: FourCC of the output video
+    :param log: Called with every line of the report
+    :return: summary: Dict with the number of frames, the wall time, the sustained frame rate and the busy time of
+     every stage
+    """
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise OSError("Could not open '%s'" % source)
+    ok, first = capture.read()
+    if not ok:
+        raise ValueError("'%s' has no frames" % source)
+    fps = fps or capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+
+    max_frames = 2 * queue_size + workers    # Frames in flight between the decoder and the encoder
+    slots = threading.Semaphore(max_frames)    # Taken by the decoder for every frame and given back once it is written
+    pool = BufferPool([np.empty_like(first) for _ in range(max_frames - 1)])    # With the first frame, which joins
+    # the pool once transformed, there is a buffer for every frame in flight so the decoder never waits for one
+    frames = queue.Queue(maxsize=queue_size)    # Decoded frames waiting for a transform worker
+    results = queue.Queue(maxsize=queue_size)    # Transformed frames waiting for the encoder
+    stop = threading.Event()
+    errors = []
+    busy = {'decode': 0.0, 'transform': 0.0, 'encode': 0.0}    # Seconds every stage spent working
+    lock = threading.Lock()
+    written = [0]
+
+    def guarded(stage_function):
+        def run():
+            try:
+                stage_function()
+            except Exception as error:    # Any failure stops the whole stream
+                errors.append(error)
+                stop.set()
+        return run
+
+    def decode():
+        frame, index = first, 0
+        while not stop.is_set():
+            if not slots.acquire(timeout=POLL_TIMEOUT):    # Too many frames in flight, wait for the encoder
+                continue
+            if index:    # The first frame was already read to size the buffers
+                start = time.perf_counter()
+                buffer = pool.acquire()
+                ok, frame = capture.read(buffer)    # Decodes into the buffer when the frame size matches
+                busy['decode'] += time.perf_counter() - start
+                if not ok:
+                    pool.release(buffer)
+                    slots.release()
+                    break
+            if not _put(frames, (index, frame), stop):
+                break
+            index += 1
+        for _ in range(workers):
+            _put(frames, _END, stop)
+
+    def transform():
+        while True:
+            item = _get(frames, stop)
+            if item is None or item is _END:
+                break
+            index, frame = item
+            start = time.perf_counter()
+            result = transform_frame(frame, recipe)
+            if np.may_share_memory(result, frame):    # An empty recipe returns the frame itself
+                result = result.copy()
+            pool.release(frame)
+            with lock:
+                busy['transform'] += time.perf_counter() - start
+            if not _put(results, (index, result), stop):
+                break
+        _put(results, _END, stop)
+
+    def encode():
+        writer = None
+        pending = {}    # Transformed frames which arrived before an earlier frame, by index
+        finished = 0
+        try:
+            while finished < workers:
+                item = _get(results, stop)
+                if item is None:
+                    break
+                if item is _END:
+                    finished += 1
+                    continue
+                pending[item[0]] = item[1]
+                while written[0] in pending:    # Frames are written in input order
+                    frame = pending.pop(written[0])
+                    start = time.perf_counter()
+                    if writer is None:
+                        writer = open_writer(destination, fps, (frame.shape[1], frame.shape[0]), codec)
+                    writer.write(frame)
+                    busy['encode'] += time.perf_counter() - start
+                    written[0] += 1
+                    slots.release()
+        finally:
+            if writer is not None:
+                writer.release()
+
+    threads = [threading.Thread(target=guarded(decode), name='decode', daemon=True)]
+    threads += [threading.Thread(target=guarded(transform), name='transform-%d' % i, daemon=True)
+                for i in range(workers)]
+    threads += [threading.Thread(target=guarded(encode), name='encode', daemon=True)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while threads[-1].is_alive():    # Report the progress until the encoder is done
+        threads[-1].join(REPORT_INTERVAL)
+        elapsed = time.perf_counter() - start
+        if threads[-1].is_alive():
+            log("%d frames, %.1f fps, queues: decoded %d/%d, transformed %d/%d" % (
+                written[0], written[0]/elapsed, frames.qsize(), queue_size, results.qsize(), queue_size))
+    stop.set()    # Releases the stages still waiting if the encoder stopped early
+    for thread in threads:
+        thread.join()
+    capture.release()
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    summary = dict({'frames': written[0], 'seconds': elapsed, 'fps': written[0]/elapsed if elapsed else 0.0},
+                   **{stage + '_seconds': seconds for stage, seconds in busy.items()})
+    log("%d frames in %.2f s: %.1f fps sustained. Busy: decode %.2f s, transform %.2f s (%d workers), encode %.2f s"
+        % (written[0], elapsed, summary['fps'], busy['decode'], busy['transform'], workers, busy['encode']))
+    return summary
+
+
+def main(argv=None):
+    """
+    Command line entry point, e.g. python video.py recipe.json input.mp4 -o output.mp4 --workers 2
+    """
+    parser = argparse.ArgumentParser(description="Apply an edit recipe to every frame of a video or frame sequence")
+    parser.add_argument('recipe', help="JSON file with the list of steps to apply")
+    parser.add_argument('input', help="Input video, or numbered frames such as 'frames/frame_%%04d.png'")
+    parser.add_argument('-o', '--output', required=True, help="Output video, or numbered frames pattern")
+    parser.add_argument('--workers', type=int, default=1, help="Frames transformed concurrently")
+    parser.add_argument('--queue', type=int, default=DEFAULT_QUEUE, help="Capacity of the queues between stages")
+    parser.add_argument('--fps', type=float, default=None, help="Frame rate of the output (default: the input's)")
+    parser.add_argument('--codec', default=DEFAULT_CODEC, help="FourCC of the output video")
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+    run_stream(recipe, args.input, args.output, workers=args.workers, queue_size=args.queue, fps=args.fps,
+               codec=args.codec)
+    return 0
+
+
+if __name__ == '__main__':    # If this file is run on the terminal
+    sys.exit(main())